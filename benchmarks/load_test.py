@@ -0,0 +1,351 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Load test of the chat server without openai or weaviate: a stub llm
+#      streams tokens with a set delay, an in-memory store stands in for the
+#      vector database and postgres is the one from .env (POSTGRES_HOST/PORT).
+#      Drives concurrent POST /chat/, GET /chat/ and /upload/ clients against
+#      a real uvicorn server and prints the results as json.
+#
+#      python benchmarks/load_test.py --clients 20 --requests 10 --output results.json
+
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Awaitable, Callable
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='chat server load test')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent clients per scenario')
+    parser.add_argument('--requests', type=int, default=10, help='requests per client per scenario')
+    parser.add_argument('--scenarios', default='post_chat,get_chat,upload',
+                        help='comma separated, run in this order')
+    parser.add_argument('--tokens', type=int, default=50, help='tokens the stub llm streams per answer')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='seconds between stub llm tokens')
+    parser.add_argument('--retrieve', action='store_true', help='the stub llm calls the retrieve tool first')
+    parser.add_argument('--search-delay', type=float, default=0.02, help='seconds a stub vector search takes')
+    parser.add_argument('--upload-pages', type=int, default=20, help='pages of each generated PDF')
+    parser.add_argument('--history-limit', type=int, default=20, help='turns per GET /chat/')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='event loop lag sampling interval')
+    parser.add_argument('--output', help='write the json here instead of stdout')
+    return parser.parse_args()
+
+
+## Percentiles
+
+def percentiles(values: list[float]) -> dict[str, float] | None:
+    """p50/p95/p99/mean/max in milliseconds of values in seconds."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99),
+        'mean': sum(ordered) / len(ordered) * 1000, 'max': ordered[-1] * 1000,
+    }
+
+
+@dataclass
+class Sample:
+    ok: bool
+    latency: float  # request sent to the last byte read
+    ttfb: float | None = None  # request sent to the first byte
+    first_token: float | None = None  # request sent to the first line of the llm answer
+    completed: float | None = None  # upload sent to the job finishing
+    status: int | None = None  # http status, 429/503 are requests turned away by admission control
+
+
+def summarize(samples: list[Sample], wall: float) -> dict[str, Any]:
+    ok = [s for s in samples if s.ok]
+    summary: dict[str, Any] = {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'seconds': wall,
+        'requests_per_second': len(ok) / wall if wall else 0.0,
+        'latency_ms': percentiles([s.latency for s in ok]),
+        'ttfb_ms': percentiles([s.ttfb for s in ok if s.ttfb is not None]),
+    }
+    statuses: dict[str, int] = {}
+    for s in samples:
+        statuses[str(s.status)] = statuses.get(str(s.status), 0) + 1
+    summary['status_codes'] = statuses
+    if any(s.first_token is not None for s in ok):
+        summary['first_token_ms'] = percentiles([s.first_token for s in ok if s.first_token is not None])
+    if any(s.completed is not None for s in ok):
+        summary['ingest_ms'] = percentiles([s.completed for s in ok if s.completed is not None])
+    return summary
+
+
+## Stand-ins for openai and the vector database
+
+class StubBackend:
+    """In-memory document store that answers every search after ``delay`` seconds."""
+
+    needs_vectors = False
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._chunks: list[dict[str, Any]] = []
+        self._lock = Lock()
+
+    def add_chunks(self, chunks) -> int:
+        added = [chunk.properties() for chunk, _ in chunks]
+        with self._lock:
+            self._chunks.extend(added)
+        return len(added)
+
+    def search(self, text: str, limit: int, query_vector=None) -> list:
+        from document_store import SearchHit
+        time.sleep(self.delay)
+        with self._lock:
+            return [SearchHit(dict(props), 1.0) for props in self._chunks[-limit:]]
+
+    def keyword_search(self, text: str, limit: int) -> list:
+        return self.search(text, limit)
+
+    def has_source(self, source_id: str) -> bool:
+        return False
+
+    def stored_vectors(self, content_hashes: list[str]) -> dict:
+        return {}
+
+    def delete_source(self, source_id: str) -> int:
+        return 0
+
+    def is_ready(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+def stub_model(tokens: int, token_delay: float, retrieve: bool):
+    from pydantic_ai.messages import ModelRequest, ToolReturnPart
+    from pydantic_ai.models.function import DeltaToolCall, FunctionModel
+
+    async def stream(messages, info):
+        last = messages[-1]
+        tool_returned = isinstance(last, ModelRequest) and any(isinstance(p, ToolReturnPart) for p in last.parts)
+        if retrieve and not tool_returned:
+            yield {0: DeltaToolCall(name='retrieve', json_args=json.dumps({'search_query': 'benchmark question'}))}
+            return
+        for i in range(tokens):
+            await asyncio.sleep(token_delay)
+            yield f'token{i} '
+
+    return FunctionModel(stream_function=stream)
+
+
+def stub_summary_model():
+    from pydantic_ai.messages import ModelResponse, TextPart
+    from pydantic_ai.models.function import FunctionModel
+
+    async def summarize(messages, info):
+        return ModelResponse(parts=[TextPart('The user asked benchmark questions.')])
+
+    return FunctionModel(summarize)
+
+
+def make_pdf(pages: int) -> bytes:
+    import fitz  # PyMuPDF
+
+    marker = uuid.uuid4().hex  # every upload is a new document, not a duplicate
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page()
+        text = f'Benchmark document {marker}, page {number + 1}. ' + 'The quick brown fox jumps over the lazy dog. ' * 40
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontsize=10)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+## The server, on its own thread and event loop like in production
+
+class ServerThread:
+    def __init__(self, app, lag_interval: float):
+        import uvicorn
+
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning'))
+        self.lag_interval = lag_interval
+        self.lag_samples: list[float] = []
+        self.measure_lag = False
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread = threading.Thread(target=self._run, name='server', daemon=True)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._lag_monitor())
+        self.loop.run_until_complete(self.server.serve())
+
+    async def _lag_monitor(self):
+        # how late a short sleep wakes up is how long the loop was busy with something else
+        while not self.server.should_exit:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            if self.measure_lag:
+                self.lag_samples.append(max(0.0, time.perf_counter() - start - self.lag_interval))
+
+    def start(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}'
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+## Scenarios
+
+async def post_chat(client, conversation_id: str, request: int) -> Sample:
+    start = time.perf_counter()
+    ttfb = first_token = None
+    received = b''
+    data = {'prompt': f'benchmark question {request} {uuid.uuid4().hex[:8]}', 'conversation_id': conversation_id}
+    async with client.stream('POST', '/chat/', data=data) as response:
+        async for chunk in response.aiter_bytes():
+            now = time.perf_counter() - start
+            if ttfb is None:
+                ttfb = now
+            received += chunk
+            if first_token is None and b'"model"' in received:
+                first_token = now
+    return Sample(response.status_code == 200, time.perf_counter() - start, ttfb, first_token, status=response.status_code)
+
+
+async def get_chat(client, conversation_id: str, limit: int) -> Sample:
+    start = time.perf_counter()
+    ttfb = None
+    params = {'conversation_id': conversation_id, 'limit': limit}
+    async with client.stream('GET', '/chat/', params=params) as response:
+        async for _ in response.aiter_bytes():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    return Sample(response.status_code == 200, time.perf_counter() - start, ttfb, status=response.status_code)
+
+
+async def upload(client, pdf: bytes) -> Sample:
+    start = time.perf_counter()
+    files = {'file': ('benchmark.pdf', pdf, 'application/pdf')}
+    response = await client.post('/upload/', files=files)
+    latency = time.perf_counter() - start
+    if response.status_code != 202:
+        return Sample(False, latency, status=response.status_code)
+    status_url = response.json()['status_url']
+    while True:
+        await asyncio.sleep(0.05)
+        job = (await client.get(status_url)).json()
+        if job['status'] in ('done', 'failed'):
+            return Sample(
+                job['status'] == 'done', latency, latency, completed=time.perf_counter() - start, status=202,
+            )
+
+
+async def run_scenario(
+        clients: int, requests: int, call: Callable[[int, int], Awaitable[Sample]]
+) -> tuple[list[Sample], float]:
+    samples: list[Sample] = []
+
+    async def client_loop(client_number: int):
+        for request in range(requests):
+            start = time.perf_counter()
+            try:
+                samples.append(await call(client_number, request))
+            except Exception:
+                samples.append(Sample(False, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop(i) for i in range(clients)))
+    return samples, time.perf_counter() - start
+
+
+async def drive(base_url: str, server: ServerThread, args: argparse.Namespace) -> dict[str, Any]:
+    import httpx
+
+    run_id = uuid.uuid4().hex[:8]
+    conversations = [f'bench-{run_id}-{i}' for i in range(args.clients)]
+    pdfs = [make_pdf(args.upload_pages) for _ in range(args.clients)] if 'upload' in args.scenarios else []
+    results: dict[str, Any] = {}
+    limits = httpx.Limits(max_connections=args.clients * 2, max_keepalive_connections=args.clients * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        for scenario in args.scenarios.split(','):
+            if scenario == 'post_chat':
+                call = lambda i, r: post_chat(client, conversations[i], r)
+            elif scenario == 'get_chat':
+                call = lambda i, r: get_chat(client, conversations[i], args.history_limit)
+            elif scenario == 'upload':
+                call = lambda i, r: upload(client, pdfs[i] if r == 0 else make_pdf(args.upload_pages))
+            else:
+                raise SystemExit(f'unknown scenario {scenario!r}')
+            server.lag_samples.clear()
+            server.measure_lag = True
+            samples, wall = await run_scenario(args.clients, args.requests, call)
+            server.measure_lag = False
+            results[scenario] = summarize(samples, wall)
+            results[scenario]['event_loop_lag_ms'] = percentiles(server.lag_samples)
+        results['server_stats'] = (await client.get('/stats/')).json()
+    return results
+
+
+def main():
+    args = parse_args()
+    # repeated prompts would be answered from the cache and measure nothing
+    os.environ.setdefault('RESPONSE_CACHE_SIZE', '0')
+    # every client comes from 127.0.0.1, the per-client limit would only measure itself
+    os.environ.setdefault('RATE_LIMIT_PER_MINUTE', '0')
+    os.environ.setdefault('LOGFIRE_IGNORE_NO_CONFIG', '1')
+
+    import chat_server
+    import vector_db
+
+    vector_db._backend = StubBackend(args.search_delay)
+    server = ServerThread(chat_server.app, args.lag_interval)
+    with chat_server.agent.override(model=stub_model(args.tokens, args.token_delay, args.retrieve)), \
+            chat_server.summary_agent.override(model=stub_summary_model()):
+        base_url = server.start()
+        try:
+            results = asyncio.run(drive(base_url, server, args))
+        finally:
+            server.stop()
+
+    report = {
+        'config': vars(args),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
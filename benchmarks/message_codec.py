@@ -0,0 +1,120 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Compares the storage formats of message_list blobs: bytes per turn
+#      and the time to turn a stored blob back into messages
+#
+#      python benchmarks/message_codec.py [--turns 200] [--json]
+
+
+from __future__ import annotations as _annotations
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+from pydantic_ai.messages import (  # noqa: E402
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+from message_codec import CODECS, decode_messages, encode_messages, zstandard  # noqa: E402
+from pdf_text import extract_text_from_pdf  # noqa: E402
+
+
+def sample_documents() -> list[str]:
+    """Text of the PDFs in pdfs/, what a retrieve result used to contain."""
+    return [extract_text_from_pdf(str(path)) for path in sorted((ROOT / 'pdfs').glob('*.pdf'))]
+
+
+def chat_turn(i: int) -> bytes:
+    now = datetime.now(tz=timezone.utc)
+    return ModelMessagesTypeAdapter.dump_json([
+        ModelRequest(parts=[UserPromptPart(content=f'question number {i}, what is the weather like?', timestamp=now)]),
+        ModelResponse(parts=[TextPart(content='It is sunny and 21°C in Mississauga today. ' * 3)], timestamp=now),
+    ])
+
+
+def retrieve_turn(i: int, document: str) -> bytes:
+    now = datetime.now(tz=timezone.utc)
+    return ModelMessagesTypeAdapter.dump_json([
+        ModelRequest(parts=[UserPromptPart(content=f'what does my essay say about ai? ({i})', timestamp=now)]),
+        ModelResponse(parts=[ToolCallPart.from_raw_args('retrieve', {'search_query': 'ai essay'})], timestamp=now),
+        ModelRequest(parts=[ToolReturnPart(tool_name='retrieve', content=document, timestamp=now)]),
+        ModelResponse(parts=[TextPart(content='Your essay argues that ... ' * 10)], timestamp=now),
+    ])
+
+
+def measure(turns: list[bytes], codec: str) -> dict[str, float]:
+    version = CODECS[codec]
+    start = time.perf_counter()
+    blobs = [encode_messages(turn, version)[0] for turn in turns]
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for blob in blobs:
+        decode_messages(blob, version)
+    decompress_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for blob in blobs:
+        ModelMessagesTypeAdapter.validate_json(decode_messages(blob, version))
+    decode_seconds = time.perf_counter() - start
+
+    stored = sum(len(blob) for blob in blobs)
+    return {
+        'codec': codec,
+        'version': version,
+        'bytes_total': stored,
+        'bytes_per_turn': stored / len(turns),
+        'ratio': sum(len(t) for t in turns) / stored,
+        'encode_us_per_turn': encode_seconds / len(turns) * 1e6,
+        'decompress_us_per_turn': decompress_seconds / len(turns) * 1e6,
+        'decode_us_per_turn': decode_seconds / len(turns) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message_list storage format benchmark")
+    parser.add_argument('--turns', type=int, default=200, help='turns of each kind')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    documents = sample_documents() or ['lorem ipsum dolor sit amet. ' * 2000]
+    workloads = {
+        'chat': [chat_turn(i) for i in range(args.turns)],
+        'retrieve': [retrieve_turn(i, documents[i % len(documents)]) for i in range(args.turns)],
+    }
+    codecs = [codec for codec in CODECS if codec != 'zstd' or zstandard is not None]
+    results = {name: [measure(turns, codec) for codec in codecs] for name, turns in workloads.items()}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, rows in results.items():
+        print(f'\n{name} turns ({args.turns})')
+        print(f'{"codec":<6} {"bytes/turn":>11} {"ratio":>6} {"encode us":>10} {"decompress us":>14} {"decode us":>10}')
+        for row in rows:
+            print(
+                f'{row["codec"]:<6} {row["bytes_per_turn"]:>11.0f} {row["ratio"]:>6.1f} '
+                f'{row["encode_us_per_turn"]:>10.1f} {row["decompress_us_per_turn"]:>14.1f} {row["decode_us_per_turn"]:>10.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
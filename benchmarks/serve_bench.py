@@ -0,0 +1,205 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Requests per second of the dev launch (python server/chat_server.py,
+#      one reloading worker, json module) against the production one
+#      (python server/serve.py, WEB_WORKERS workers, uvloop/httptools, orjson).
+#      Starts each as a subprocess on port 8000 and drives endpoints that do
+#      not call openai: a page of chat history, the help answer and the
+#      liveness check. Postgres from .env has to be running.
+#
+#      python benchmarks/serve_bench.py --workers 4 --clients 64 --duration 15 --output serve.json
+
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from load_test import percentiles
+
+ROOT = Path(__file__).parent.parent
+BASE_URL = 'http://127.0.0.1:8000'  # the dev launch always listens here
+
+MODES = {
+    # the launch before serve.py, frames encoded with the json module
+    'dev': ([sys.executable, 'server/chat_server.py'], {'NDJSON_ENCODER': 'json'}),
+    'prod': ([sys.executable, 'server/serve.py'], {'WEB_HOST': '127.0.0.1', 'WEB_PORT': '8000'}),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='dev launch against production launch')
+    parser.add_argument('--modes', default='dev,prod', help='comma separated, run in this order')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='WEB_WORKERS of prod')
+    parser.add_argument('--scenarios', default='history,help,live', help='comma separated')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent connections in total')
+    parser.add_argument('--client-processes', type=int, default=2,
+                        help='processes the clients are spread over, so the client is not the bottleneck')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--history-turns', type=int, default=50, help='turns in the conversation read back')
+    parser.add_argument('--output', help='write the json here instead of stdout')
+    return parser.parse_args()
+
+
+## The server
+
+def start_server(mode: str, workers: int) -> subprocess.Popen:
+    command, env = MODES[mode]
+    env = {**os.environ, **env, 'WEB_WORKERS': str(workers)}
+    # nothing here calls openai but the agent wants a key to be created
+    env.setdefault('OPENAI_API_KEY', 'not-used')
+    env.setdefault('RATE_LIMIT_PER_MINUTE', '0')
+    env.setdefault('LOGFIRE_IGNORE_NO_CONFIG', '1')
+    # own process group, so the reloader or worker processes go down with it
+    process = subprocess.Popen(
+        command, cwd=ROOT, env=env, start_new_session=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    wait_until_live(process)
+    return process
+
+
+def wait_until_live(process: subprocess.Popen, timeout: float = 120.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'server exited with {process.returncode}, is port 8000 free and postgres up?')
+        try:
+            if httpx.get(f'{BASE_URL}/health/live', timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit('server did not come up')
+
+
+def stop_server(process: subprocess.Popen):
+    os.killpg(process.pid, signal.SIGINT)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def seed_conversation(conversation_id: str, turns: int):
+    """Turns answered by the help fast path, stored like any other turn."""
+    import httpx
+
+    with httpx.Client(base_url=BASE_URL, timeout=30) as client:
+        for _ in range(turns):
+            client.post('/chat/', data={'prompt': 'help', 'conversation_id': conversation_id}).read()
+
+
+## The clients
+
+def request(scenario: str, conversation_id: str, turns: int) -> tuple[str, str, dict]:
+    if scenario == 'history':
+        return 'GET', '/chat/', {'params': {'conversation_id': conversation_id, 'limit': turns}}
+    if scenario == 'help':
+        # a conversation per request, the seeded one would keep growing
+        return 'POST', '/chat/', {'data': {'prompt': 'help', 'conversation_id': f'bench-{uuid.uuid4().hex[:16]}'}}
+    if scenario == 'live':
+        return 'GET', '/health/live', {}
+    raise SystemExit(f'unknown scenario {scenario!r}')
+
+
+async def drive(scenario: str, clients: int, duration: float, conversation_id: str, turns: int) -> dict[str, Any]:
+    import httpx
+
+    latencies: list[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client_loop(client: httpx.AsyncClient):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            method, url, kwargs = request(scenario, conversation_id, turns)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=60, limits=limits) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(clients)))
+    return {'latencies': latencies, 'errors': errors}
+
+
+def client_process(args: tuple) -> dict[str, Any]:
+    return asyncio.run(drive(*args))
+
+
+def run_scenario(scenario: str, args: argparse.Namespace, conversation_id: str) -> dict[str, Any]:
+    processes = max(1, min(args.client_processes, args.clients))
+    per_process = [args.clients // processes + (i < args.clients % processes) for i in range(processes)]
+    jobs = [(scenario, n, args.duration, conversation_id, args.history_turns) for n in per_process]
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        results = pool.map(client_process, jobs)
+    latencies = [latency for result in results for latency in result['latencies']]
+    return {
+        'requests': len(latencies),
+        'errors': sum(result['errors'] for result in results),
+        'requests_per_second': len(latencies) / args.duration,
+        'latency_ms': percentiles(latencies),
+    }
+
+
+def main():
+    args = parse_args()
+    results: dict[str, Any] = {}
+    for mode in args.modes.split(','):
+        process = start_server(mode, args.workers)
+        try:
+            conversation_id = f'bench-{uuid.uuid4().hex[:8]}'
+            if 'history' in args.scenarios:
+                seed_conversation(conversation_id, args.history_turns)
+            results[mode] = {
+                scenario: run_scenario(scenario, args, conversation_id) for scenario in args.scenarios.split(',')
+            }
+        finally:
+            stop_server(process)
+
+    report = {
+        'config': vars(args),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    for scenario in args.scenarios.split(','):
+        row = ', '.join(
+            f'{mode} {results[mode][scenario]["requests_per_second"]:.0f} req/s' for mode in results
+        )
+        print(f'{scenario}: {row}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,9 +13,20 @@ const convElement = document.getElementById('conversation')
 const promptInput = document.getElementById('prompt-input') as HTMLInputElement
 const spinner = document.getElementById('spinner')
 
+// each browser tab keeps its own conversation, it survives reloads but not new tabs
+function getConversationId(): string {
+  let conversationId = sessionStorage.getItem('conversationId')
+  if (!conversationId) {
+    conversationId = crypto.randomUUID()
+    sessionStorage.setItem('conversationId', conversationId)
+  }
+  return conversationId
+}
+const conversationId = getConversationId()
+
 // output the response from the server
 async function onFetchResponse(response: Response): Promise<void> {
-  let text = ''
+  let buffer = ''
   let decoder = new TextDecoder()
   if (response.ok) {
     const reader = response.body.getReader()
@@ -24,11 +35,16 @@ async function onFetchResponse(response: Response): Promise<void> {
       if (done) {
         break
       }
-      text += decoder.decode(value)
-      addMessages(text)
+      // only render complete lines, a chunk can end part way through one
+      buffer += decoder.decode(value, {stream: true})
+      const end = buffer.lastIndexOf('\n')
+      if (end >= 0) {
+        addMessages(buffer.slice(0, end))
+        buffer = buffer.slice(end + 1)
+      }
       spinner.classList.remove('active')
     }
-    addMessages(text)
+    addMessages(buffer + decoder.decode())
     promptInput.disabled = false
     promptInput.focus()
   } else {
@@ -43,29 +59,85 @@ interface Message {
   role: string
   content: string
   timestamp: string
+  turn?: number
+}
+
+function parseMessages(responseText: string): Message[] {
+  const lines = responseText.split('\n')
+  return lines.filter(line => line.length > 1).map(j => JSON.parse(j))
+}
+
+function messageDiv(message: Message): [HTMLElement, boolean] {
+  const {timestamp, role, content, turn} = message
+  if (turn !== undefined && (oldestTurn === null || turn < oldestTurn)) {
+    oldestTurn = turn
+  }
+  const id = `msg-${timestamp}`
+  let msgDiv = document.getElementById(id)
+  const isNew = !msgDiv
+  if (!msgDiv) {
+    msgDiv = document.createElement('div')
+    msgDiv.id = id
+    msgDiv.title = `${role} at ${timestamp}`
+    msgDiv.classList.add('border-top', 'pt-2', role)
+  }
+  msgDiv.innerHTML = marked.parse(content)
+  return [msgDiv, isNew]
 }
 
 // Add messages to the conversation 
 function addMessages(responseText: string) {
-  const lines = responseText.split('\n')
-  const messages: Message[] = lines.filter(line => line.length > 1).map(j => JSON.parse(j))
-  for (const message of messages) {
-    
-    const {timestamp, role, content} = message
-    const id = `msg-${timestamp}`
-    let msgDiv = document.getElementById(id)
-    if (!msgDiv) {
-      msgDiv = document.createElement('div')
-      msgDiv.id = id
-      msgDiv.title = `${role} at ${timestamp}`
-      msgDiv.classList.add('border-top', 'pt-2', role)
+  for (const message of parseMessages(responseText)) {
+    const [msgDiv, isNew] = messageDiv(message)
+    if (isNew) {
       convElement.appendChild(msgDiv)
     }
-    msgDiv.innerHTML = marked.parse(content)
   }
   window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' })
 }
 
+// older history is loaded a page at a time when scrolling to the top
+const historyPageTurns = 20
+let oldestTurn: number | null = null
+let moreHistory = true
+let loadingHistory = false
+
+async function loadOlderMessages(): Promise<void> {
+  if (loadingHistory || !moreHistory || oldestTurn === null) {
+    return
+  }
+  loadingHistory = true
+  try {
+    const params = new URLSearchParams({
+      conversation_id: conversationId, before: String(oldestTurn), limit: String(historyPageTurns),
+    })
+    const response = await fetch(`/chat/?${params}`)
+    const messages = parseMessages(await response.text())
+    if (messages.length === 0) {
+      moreHistory = false
+      return
+    }
+    // keep what is on screen in place while older messages go in above it
+    const heightBefore = document.body.scrollHeight
+    const first = convElement.firstChild
+    for (const message of messages) {
+      const [msgDiv, isNew] = messageDiv(message)
+      if (isNew) {
+        convElement.insertBefore(msgDiv, first)
+      }
+    }
+    window.scrollBy(0, document.body.scrollHeight - heightBefore)
+  } finally {
+    loadingHistory = false
+  }
+}
+
+window.addEventListener('scroll', () => {
+  if (window.scrollY < 200) {
+    loadOlderMessages().catch(onError)
+  }
+})
+
 function onError(error: any) {
   console.error(error)
   document.getElementById('error').classList.remove('d-none')
@@ -83,11 +155,22 @@ async function onSubmit(e: SubmitEvent): Promise<void> {
   fileInput.value = ''
 
   const body = new FormData(e.target as HTMLFormElement)
+  body.append('conversation_id', conversationId)
 
   promptInput.value = ''
   promptInput.disabled = true
 
   const response = await fetch('/chat/', {method: 'POST', body})
+  if (response.status === 429 || response.status === 503) {
+    // turned away because the server is busy, give the prompt back so it can be sent again
+    const result = await response.json()
+    const retryAfter = response.headers.get('Retry-After')
+    messageDiv.innerHTML = `<div class="alert alert-warning">${result.message} (try again in ${retryAfter}s)</div>`
+    promptInput.value = body.get('prompt') as string
+    promptInput.disabled = false
+    spinner.classList.remove('active')
+    return
+  }
   await onFetchResponse(response)
 }
 
@@ -103,18 +186,50 @@ async function onFileUpload(e: SubmitEvent): Promise<void> {
 
   const body = new FormData(form)
   console.log('Form data:', body);
+  // only a document this browser uploaded can be replaced, the server never replaces by name
+  const filename = fileInput.files[0]?.name
+  const replaceInput = document.getElementById('replaceInput') as HTMLInputElement
+  const previous = filename ? localStorage.getItem(`document:${filename}`) : null
+  if (replaceInput.checked && previous) {
+    body.append('replaces', previous)
+  }
 
   const response = await fetch('/upload/', { method: 'POST', body })
   const result = await response.json()
   const messageDiv = document.getElementById('message')!
   if (response.ok) {
-    messageDiv.innerHTML = `<div class="alert alert-success">${result.message}</div>`
+    messageDiv.innerHTML = `<div class="alert alert-info">${result.message}</div>`
+    await pollUpload(result.status_url, messageDiv)
   } else {
     messageDiv.innerHTML = `<div class="alert alert-danger">${result.message}</div>`
   }
   spinner.classList.remove('active')
 }
 
+// the server processes uploads in the background, show its progress until it is done
+async function pollUpload(statusUrl: string, messageDiv: HTMLElement): Promise<void> {
+  while (true) {
+    await new Promise(resolve => setTimeout(resolve, 1000))
+    const response = await fetch(statusUrl)
+    const job = await response.json()
+    if (!response.ok) {
+      messageDiv.innerHTML = `<div class="alert alert-danger">${job.message}</div>`
+      return
+    }
+    if (job.status === 'done') {
+      localStorage.setItem(`document:${job.filename}`, job.source_id)
+      messageDiv.innerHTML = `<div class="alert alert-success">${job.filename} uploaded successfully</div>`
+      return
+    }
+    if (job.status === 'failed') {
+      messageDiv.innerHTML = `<div class="alert alert-danger">${job.filename} failed: ${job.error}</div>`
+      return
+    }
+    messageDiv.innerHTML = `<div class="alert alert-info">${job.filename}: ${job.status}, `
+      + `${job.pages_parsed}/${job.pages_total} pages, ${job.chunks_embedded} chunks</div>`
+  }
+}
+
 // call onSubmit when the form is submitted or when the user presses enter
 document.getElementById('chatInput').addEventListener('submit', (e) => onSubmit(e).catch(onError))
 
@@ -135,5 +250,6 @@ document.getElementById('hideFormButton')!.addEventListener('click', () => {
   showFormButton.style.display = 'block'
 })
 
-// load messages on page load
-fetch('/chat/').then(onFetchResponse).catch(onError)
+// load the newest messages on page load, older ones follow on scroll
+fetch(`/chat/?conversation_id=${encodeURIComponent(conversationId)}&limit=${historyPageTurns}`)
+  .then(onFetchResponse).catch(onError)
@@ -0,0 +1,231 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Admission control for the llm: how many chats run at once overall and
+#      per model, a bounded queue for the rest, and a token bucket per client
+#      Requests that cannot be served soon are turned away with a Retry-After
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import math
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+from caching import TTLCache
+from metrics import registry
+
+admission_wait_seconds = registry.histogram(
+    'admission_wait_seconds', 'Time a chat waited in the queue for an llm slot',
+    (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+admission_rejected = registry.counter(
+    'admission_rejected', 'Chats turned away, by reason (queue_full, timeout or rate_limited)',
+)
+
+
+class Overloaded(Exception):
+    """Raised when no llm slot frees up in time or the wait queue is full."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_model_limits(value: str) -> dict[str, int]:
+    """``'openai:gpt-4o=8,openai:gpt-4o-mini=16'`` -> {model: limit}"""
+    limits: dict[str, int] = {}
+    for item in value.split(','):
+        if item.strip():
+            model, _, limit = item.rpartition('=')
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class Ticket:
+    """An admitted chat, holds a global and a model slot until released."""
+
+    def __init__(self, control: AdmissionControl, model: str):
+        self._control = control
+        self._model = model
+        self._admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        # called from the end of the stream and again after the response, only counts once
+        if not self._released:
+            self._released = True
+            self._control._release(self._model, time.monotonic() - self._admitted_at)
+
+
+class AdmissionControl:
+    """Concurrency limits with a bounded wait queue in front of them.
+
+    At most ``max_concurrent`` chats run at once, and at most the limit of
+    their model (``model_limits``, ``model_max_concurrent`` for the others)
+    per model. Up to ``max_queue`` more wait up to ``queue_timeout`` seconds
+    for a slot, beyond that `Overloaded` is raised with a Retry-After
+    estimated from how long chats have been holding their slots.
+    """
+
+    def __init__(
+            self, max_concurrent: int = 32, model_max_concurrent: int = 16,
+            model_limits: dict[str, int] | None = None,
+            max_queue: int = 64, queue_timeout: float = 10.0,
+    ):
+        self.max_concurrent = max_concurrent
+        self.model_max_concurrent = model_max_concurrent
+        self.model_limits = model_limits or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.queued = 0  # admitted after waiting
+        self.wait_seconds = 0.0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self._hold_seconds = 1.0  # moving average of how long a slot is held
+        self._global = asyncio.Semaphore(max_concurrent)
+        self._models: dict[str, asyncio.Semaphore] = {}
+
+    def _model_slots(self, model: str) -> asyncio.Semaphore:
+        slots = self._models.get(model)
+        if slots is None:
+            slots = self._models[model] = asyncio.Semaphore(self.model_limits.get(model, self.model_max_concurrent))
+        return slots
+
+    def retry_after(self) -> float:
+        """Seconds until the queue has likely moved on, for the Retry-After header."""
+        return min(60.0, max(1.0, self._hold_seconds * (self.waiting + 1) / self.max_concurrent))
+
+    async def acquire(self, model: str) -> Ticket:
+        """Wait for a slot for ``model``, raises `Overloaded` if none frees up in time."""
+        model_slots = self._model_slots(model)
+        if not self._global.locked() and not model_slots.locked():
+            # the common case, nothing to wait for
+            await model_slots.acquire()
+            await self._global.acquire()
+            return self._admit(model)
+
+        if self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            admission_rejected.inc(reason='queue_full')
+            raise Overloaded('too many chats waiting', self.retry_after())
+
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._acquire_both(model_slots), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            admission_rejected.inc(reason='timeout')
+            raise Overloaded(f'no llm slot free after {self.queue_timeout}s', self.retry_after()) from None
+        finally:
+            self.waiting -= 1
+            waited = time.monotonic() - start
+            admission_wait_seconds.observe(waited)
+            self.wait_seconds += waited
+        self.queued += 1
+        return self._admit(model)
+
+    async def _acquire_both(self, model_slots: asyncio.Semaphore) -> None:
+        # always the model first, then the global one, so two waiters never hold one each
+        await model_slots.acquire()
+        try:
+            await self._global.acquire()
+        except BaseException:
+            model_slots.release()
+            raise
+
+    def _admit(self, model: str) -> Ticket:
+        self.in_flight += 1
+        self.admitted += 1
+        return Ticket(self, model)
+
+    def _release(self, model: str, held: float) -> None:
+        self.in_flight -= 1
+        self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held
+        self._global.release()
+        self._models[model].release()
+
+    @asynccontextmanager
+    async def slot(self, model: str) -> AsyncIterator[None]:
+        ticket = await self.acquire(model)
+        try:
+            yield
+        finally:
+            ticket.release()
+
+    def stats(self) -> dict[str, Any]:
+        waits = self.queued + self.rejected_timeout
+        return {
+            'in_flight': self.in_flight,
+            'max_concurrent': self.max_concurrent,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'queue_capacity': self.max_queue,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'mean_wait_seconds': self.wait_seconds / waits if waits else 0.0,
+            'rejected_queue_full': self.rejected_queue_full,
+            'rejected_timeout': self.rejected_timeout,
+            'hold_seconds': self._hold_seconds,
+        }
+
+
+class RateLimiter:
+    """A token bucket per client: ``burst`` requests at once, refilled at ``per_minute``.
+
+    A bucket that has been idle long enough to be full again is dropped, so
+    only recently active clients take memory.
+    """
+
+    def __init__(self, per_minute: float = 30.0, burst: int = 10, max_clients: int = 10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.limited = 0
+        # client -> (tokens, last update)
+        self._buckets: TTLCache[str, tuple[float, float]] = TTLCache(
+            max_clients, burst / self.rate if self.rate > 0 else 0.0,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and self.burst > 0
+
+    def take(self, client: str) -> float:
+        """Use a token of ``client``, returns 0 if there was one or else the seconds until there is."""
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client) or (float(self.burst), now)
+        tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        if tokens < 1.0:
+            self._buckets.set(client, (tokens, now))
+            self.limited += 1
+            admission_rejected.inc(reason='rate_limited')
+            return (1.0 - tokens) / self.rate
+        self._buckets.set(client, (tokens - 1.0, now))
+        return 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'clients': len(self._buckets),
+            'per_minute': self.rate * 60.0,
+            'burst': self.burst,
+            'limited': self.limited,
+        }
+
+
+def retry_after_header(seconds: float) -> dict[str, str]:
+    return {'Retry-After': str(max(1, math.ceil(seconds)))}
@@ -0,0 +1,86 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Okapi BM25 keyword index for the local document backend
+
+
+from __future__ import annotations as _annotations
+
+import math
+import re
+from collections import Counter
+from threading import Lock
+
+import numpy as np
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> list[str]:
+    return WORD.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted index of documents numbered 0, 1, 2, ... in the order they are added."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, tuple[list[int], list[int]]] = {}  # term -> (doc ids, term counts)
+        self._lengths: list[int] = []
+        self._total_length = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, text: str) -> None:
+        terms = Counter(tokenize(text))
+        with self._lock:
+            doc_id = len(self._lengths)
+            for term, count in terms.items():
+                ids, counts = self._postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                counts.append(count)
+            length = sum(terms.values())
+            self._lengths.append(length)
+            self._total_length += length
+
+    def search(self, query: str, limit: int, exclude: np.ndarray | None = None) -> list[tuple[int, float]]:
+        """(doc id, score) of the best ``limit`` documents with any query term, best first.
+
+        Doc ids in ``exclude`` are never returned.
+        """
+        with self._lock:
+            count = len(self._lengths)
+            if not count:
+                return []
+            lengths = np.asarray(self._lengths, dtype=np.float32)
+            average = self._total_length / count
+            postings = [
+                (np.asarray(ids), np.asarray(counts, dtype=np.float32))
+                for term in set(tokenize(query)) if term in self._postings
+                for ids, counts in [self._postings[term]]
+            ]
+        if not postings:
+            return []
+
+        scores = np.zeros(count, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / average)
+        for ids, counts in postings:
+            idf = math.log(1 + (count - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * counts * (self.k1 + 1) / (counts + norm[ids])
+        if exclude is not None and len(exclude):
+            scores[exclude[exclude < count]] = 0
+
+        matched = np.flatnonzero(scores)
+        k = min(limit, len(matched))
+        if k <= 0:
+            return []
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
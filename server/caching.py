@@ -0,0 +1,122 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Small in-process caches shared by the server modules
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache whose entries also expire ``ttl`` seconds after being set.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def items(self) -> list[tuple[K, V]]:
+        """The entries that have not expired, least recently used first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expires, value) in self._entries.items() if expires >= now]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class AsyncTTLCache(Generic[K, V]):
+    """`TTLCache` for values loaded by coroutines, used from the event loop.
+
+    Concurrent misses on the same key share a single load (single-flight).
+    The load runs as its own task, so a caller that goes away does not
+    cancel it for the others. Failed loads are not cached.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.coalesced = 0
+        self._cache: TTLCache[K, V] = TTLCache(max_entries, ttl)
+        self._loading: dict[K, asyncio.Task[V]] = {}
+
+    async def get_or_load(self, key: K, load: Callable[[], Awaitable[V]]) -> V:
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, load))
+            # nobody may be left waiting for a failed load, do not log it as unretrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._loading[key] = task
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, key: K, load: Callable[[], Awaitable[V]]) -> V:
+        try:
+            value = await load()
+            self._cache.set(key, value)
+            return value
+        finally:
+            self._loading.pop(key, None)
+
+    def stats(self) -> dict[str, int | float]:
+        return {**self._cache.stats(), 'coalesced': self.coalesced, 'loading': len(self._loading)}
@@ -10,7 +10,7 @@
 #      Will hold the chat back end logic
 
 from __future__ import annotations as _annotations
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 import fastapi
 from fastapi.responses import FileResponse
 from pathlib import Path
@@ -19,7 +19,6 @@ from pydantic_ai import Agent, ModelRetry, RunContext
 
 
 import asyncio
-import json
 from collections.abc import AsyncIterator
 from concurrent.futures.thread import ThreadPoolExecutor
 from dataclasses import dataclass
@@ -29,6 +28,9 @@ from pathlib import Path
 from typing import Annotated, Any, Callable, Dict, Literal, Optional, TypeVar, Union
 import sys
 import os
+import shutil
+import tempfile
+import time
 import uuid
 from dotenv import load_dotenv
 
@@ -41,9 +43,11 @@ import logging
 from httpx import AsyncClient
 
 from fastapi import Body, Depends, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
 from pydantic_ai import Agent
 from pydantic_ai.exceptions import UnexpectedModelBehavior
 from pydantic_ai.messages import (
@@ -55,37 +59,139 @@ from pydantic_ai.messages import (
     UserPromptPart,
 )
 
-from database import Database
-from vector_db import extract_text_from_pdf, ingest_text_to_weaviate, weaviate_client, search_documents
+from admission import AdmissionControl, Overloaded, RateLimiter, parse_model_limits, retry_after_header
+from compaction import Compactor, prompt_tokens
+from database import DEFAULT_CONVERSATION, DOCUMENTS_CHANNEL, Database
+from history_cache import CachedTurn, HistoryCache
+from persistence import TurnWriter
+from upload_jobs import TooManyUploads, UploadJob, UploadJobs
+from pdf_text import extract_pages_from_pdf, shutdown_pool as shutdown_pdf_pool
+from caching import AsyncTTLCache
+from http_client import create_http_client, get_json
+from ndjson import ndjson_line, ndjson_lines
+from metrics import history_bytes, history_messages, history_tokens, llm_requests, llm_tokens, registry, stage, stage_seconds
+from response_cache import ResponseCache, match_intent
+from retrieval_cache import normalize_query
+from retrieval import pack_context
+from tokens import estimate_tokens
+from document_store import file_hash
+from vector_db import (
+    DocumentStoreUnavailable, backend_status, close_backend, connect_backend, delete_document,
+    document_stored, ingest_text_to_weaviate, retrieval_cache, search_documents_async, search_queue_depth,
+)
 
 
 dbname = os.getenv('POSTGRES_DB')
 dbuser = os.getenv('POSTGRES_USER')
 dbpass = os.getenv('POSTGRES_PASSWORD')
-dbhost = 'localhost'
-dbport = 5432
+dbhost = os.getenv('POSTGRES_HOST', 'localhost')
+dbport = int(os.getenv('POSTGRES_PORT', '5432'))
+
+# connection pool sizing, see Database.connect
+db_pool_min = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+db_pool_max = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+db_acquire_timeout = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+db_health_check_interval = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))
+
+# how many passages the retrieve tool considers and how many tokens of them it returns
+retrieve_limit = int(os.getenv('RETRIEVE_LIMIT', '8'))
+rag_token_budget = int(os.getenv('RAG_TOKEN_BUDGET', '1500'))
+
+# help/about/mark prompts are answered without the llm, repeated prompts from a cache
+fast_path = os.getenv('FAST_PATH', '1') == '1'
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', '3600')),
+    history_turns=int(os.getenv('RESPONSE_CACHE_HISTORY_TURNS', os.getenv('HISTORY_TURNS', '20'))),
+)
+
+# how many of the most recent turns are sent to the llm as history
+history_turns = int(os.getenv('HISTORY_TURNS', '20'))
+# turns per page of GET /chat/ when the browser does not ask for a number
+history_page_turns = int(os.getenv('HISTORY_PAGE_TURNS', '20'))
+
+# admission control in front of the llm, see AdmissionControl and RateLimiter
+max_concurrent_chats = int(os.getenv('MAX_CONCURRENT_CHATS', '32'))
+model_max_concurrent = int(os.getenv('MODEL_MAX_CONCURRENT', '16'))
+model_concurrency = parse_model_limits(os.getenv('MODEL_CONCURRENCY', ''))
+admission_queue_size = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+admission_queue_timeout = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10'))
+rate_limiter = RateLimiter(
+    per_minute=float(os.getenv('RATE_LIMIT_PER_MINUTE', '30')),
+    burst=int(os.getenv('RATE_LIMIT_BURST', '10')),
+)
+
+# older turns are summarized in the background once the history sent to the llm
+# is over this many tokens, see Compactor (0 turns it off)
+compact_threshold_tokens = int(os.getenv('COMPACT_THRESHOLD_TOKENS', '6000'))
+compact_keep_turns = int(os.getenv('COMPACT_KEEP_TURNS', '6'))
+# tool results of earlier turns (documents, weather) are cut to this many tokens
+tool_return_max_tokens = int(os.getenv('TOOL_RETURN_MAX_TOKENS', '200'))
+
+# decoded history cache, see HistoryCache
+history_cache_conversations = int(os.getenv('HISTORY_CACHE_MAX_CONVERSATIONS', '1000'))
+history_cache_mb = float(os.getenv('HISTORY_CACHE_MAX_MB', '64'))
+history_cache_ttl = float(os.getenv('HISTORY_CACHE_TTL', '300'))
+# serve.py sets WEB_WORKERS for its workers, with several of them a cached conversation is
+# checked against the newest turn in the database since another worker may have added one
+web_workers = int(os.getenv('WEB_WORKERS', '1'))
+history_cache_check = os.getenv('HISTORY_CACHE_CHECK', '1' if web_workers > 1 else '0') == '1'
+
+# background batching of message writes, see TurnWriter
+persist_batch_size = int(os.getenv('PERSIST_BATCH_SIZE', '100'))
+persist_flush_interval = float(os.getenv('PERSIST_FLUSH_INTERVAL', '0.05'))
+persist_queue_size = int(os.getenv('PERSIST_QUEUE_SIZE', '10000'))
+
+# document uploads run as background jobs, see UploadJobs
+upload_workers = int(os.getenv('UPLOAD_WORKERS', '2'))
+upload_max_pending = int(os.getenv('UPLOAD_MAX_PENDING', '20'))
+
+# turns stored in an older format are rewritten in the current one in the background
+message_migrate = os.getenv('MESSAGE_MIGRATE', '1') == '1'
+message_migrate_batch = int(os.getenv('MESSAGE_MIGRATE_BATCH', '200'))
 
 @dataclass
 class Deps:
     client: AsyncClient
 
 ## The llm agent 
+chat_model = 'openai:gpt-4o'
+SYSTEM_PROMPT = (
+    'You are a helpful assistent that can provides answers to many questions. '
+    'When a user asks for `help` or `what can you do?` specifically then use the `help` tool and output exactly the text it return.'
+    'If a the user asks for `about` or `who are you?` then use the `about` tool and output exactly the text it returns.'
+    'If the user asks for `the mark this project will get` then use the `mark` tool and output exactly the text it returns.'
+)
 agent = Agent(
-    'openai:gpt-4o',
-    system_prompt=(
-        'You are a helpful assistent that can provides answers to many questions. '
-        'When a user asks for `help` or `what can you do?` specifically then use the `help` tool and output exactly the text it return.'
-        'If a the user asks for `about` or `who are you?` then use the `about` tool and output exactly the text it returns.'
-        'If the user asks for `the mark this project will get` then use the `mark` tool and output exactly the text it returns.'
-    ), 
+    chat_model,
+    system_prompt=SYSTEM_PROMPT,
     deps_type=Deps, 
     retries=2     
 )
 
+# summarizes the older turns of long conversations, see Compactor
+summary_agent = Agent(
+    chat_model,
+    system_prompt=(
+        'Summarize the conversation between a user and an assistant below for the assistant to continue it. '
+        'Keep names, numbers, places, documents and anything the user asked to be remembered. '
+        'Write at most a few short paragraphs, no preamble.'
+    ),
+)
+
+async def summarize(admission: AdmissionControl, transcript: str) -> str:
+    # summaries share the model's slots with the chats, under load they wait for a quieter turn
+    async with admission.slot(chat_model):
+        with stage('summarize'):
+            result = await summary_agent.run(transcript)
+    usage = result.usage()
+    llm_requests.inc(usage.requests)
+    llm_tokens.inc(usage.request_tokens or 0, kind='summary_request')
+    llm_tokens.inc(usage.response_tokens or 0, kind='summary_response')
+    return result.data
+
 # Help tool
-@agent.tool
-async def help(ctx: RunContext[None]) -> str:
-    return f'''I am Amanda AI and I can help with many questions. 
+HELP_TEXT = '''I am Amanda AI and I can help with many questions. 
     
             I can assist you with a wide range of tasks, including but not limited to:
 
@@ -103,10 +209,12 @@ async def help(ctx: RunContext[None]) -> str:
             
             Feel free to ask me anything specific you need help with!'''
 
-# About tool
 @agent.tool
-async def about(ctx: RunContext[None]) -> str:
-    return f'''Amanda AI is an AI Agent developed by Amanda Uccello. 
+async def help(ctx: RunContext[None]) -> str:
+    return HELP_TEXT
+
+# About tool
+ABOUT_TEXT = '''Amanda AI is an AI Agent developed by Amanda Uccello. 
                - Creator of Amanda AI: Amanda Uccello
                - Course: ICS 4U
                - School: Port Credit Secondary School
@@ -114,14 +222,32 @@ async def about(ctx: RunContext[None]) -> str:
                - Date: January 2025
                - Model: GPT-4o
                '''
-# About tool
+
 @agent.tool
-async def mark(ctx: RunContext[None]) -> str:
-    return f'''This project should probably get 100pct but 
+async def about(ctx: RunContext[None]) -> str:
+    return ABOUT_TEXT
+
+# Mark tool
+MARK_TEXT = '''This project should probably get 100pct but 
                 I am not the teacher so I can say for sure. 
                 However, the project is probably a great start to creating an AI startup!
                '''
 
+@agent.tool
+async def mark(ctx: RunContext[None]) -> str:
+    return MARK_TEXT
+
+# what the fast path answers for each intent, without asking the llm
+INTENT_ANSWERS = {'help': HELP_TEXT, 'about': ABOUT_TEXT, 'mark': MARK_TEXT}
+
+# answers of the geocoding and weather APIs, concurrent identical lookups share one request
+geocode_cache: AsyncTTLCache[str, list] = AsyncTTLCache(
+    max_entries=int(os.getenv('GEOCODE_CACHE_SIZE', '4096')), ttl=float(os.getenv('GEOCODE_CACHE_TTL', '86400')),
+)
+weather_cache: AsyncTTLCache[tuple[float, float], dict] = AsyncTTLCache(
+    max_entries=int(os.getenv('WEATHER_CACHE_SIZE', '1024')), ttl=float(os.getenv('WEATHER_CACHE_TTL', '600')),
+)
+
 # Latitute and Longitude tool
 @agent.tool
 async def get_lat_lng(
@@ -143,11 +269,16 @@ async def get_lat_lng(
         'q': location_description,
         'api_key': geo_api_key,
     }
-    with logfire.span('calling geocode API', params=params) as span:
-        r = await ctx.deps.client.get('https://geocode.maps.co/search', params=params)
-        r.raise_for_status()
-        data = r.json()
-        span.set_attribute('response', data)
+
+    async def geocode():
+        with logfire.span('calling geocode API', params=params) as span:
+            data = await get_json(ctx.deps.client, 'https://geocode.maps.co/search', params)
+            span.set_attribute('response', data)
+        return data
+
+    # places do not move, the same description is looked up once a day at most
+    with stage('geocode'):
+        data = await geocode_cache.get_or_load(normalize_query(location_description), geocode)
 
     if data:
         return {'lat': data[0]['lat'], 'lng': data[0]['lon']}
@@ -172,18 +303,22 @@ async def get_weather(ctx: RunContext[Deps], lat: float, lng: float) -> dict[str
         # if no API key is provided, return a dummy response
         return {'temperature': '21 °C', 'description': 'Sunny'}
 
+    # about 1km apart shares the same weather, and the cache entry with it
+    lat, lng = round(lat, 2), round(lng, 2)
     params = {
         'apikey': weather_api_key,
         'location': f'{lat},{lng}',
         'units': 'metric',
     }
-    with logfire.span('calling weather API', params=params) as span:
-        r = await ctx.deps.client.get(
-            'https://api.tomorrow.io/v4/weather/realtime', params=params
-        )
-        r.raise_for_status()
-        data = r.json()
-        span.set_attribute('response', data)
+
+    async def realtime_weather():
+        with logfire.span('calling weather API', params=params) as span:
+            data = await get_json(ctx.deps.client, 'https://api.tomorrow.io/v4/weather/realtime', params)
+            span.set_attribute('response', data)
+        return data
+
+    with stage('weather'):
+        data = await weather_cache.get_or_load((lat, lng), realtime_weather)
 
     values = data['data']['values']
     # https://docs.tomorrow.io/reference/data-layers-weather-codes
@@ -226,28 +361,127 @@ async def retrieve(context: RunContext[Deps], search_query: str) -> str:
         context: The call context.
         search_query: The search query.
     """
-    ret_string = ''
-    docs = search_documents(search_query)
-    
-    for doc in docs:
-        ret_string += doc.properties["content"]
-    return ret_string
+    try:
+        with stage('retrieve'):
+            docs = await search_documents_async(search_query, retrieve_limit)
+    except asyncio.TimeoutError:
+        # answer without documents rather than hold up the chat
+        logging.warning('document search timed out for %r', search_query)
+        return 'Document search is not available right now.'
+    except DocumentStoreUnavailable as exc:
+        logging.warning('document store unavailable: %s', exc)
+        return 'Document search is not available right now.'
+
+    # best passages first, labelled with file and page, cut off at the token budget
+    return pack_context(docs, rag_token_budget)
 
 
 ## Handle the database connection
 @asynccontextmanager
 async def lifespan(_app: fastapi.FastAPI):
-    async with Database.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport) as db:
+    # connect to the document store in the background, startup does not wait for it
+    # and chat keeps working without documents if it is down
+    asyncio.get_running_loop().run_in_executor(None, connect_backend)
+    async with Database.connect(
+        dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport,
+        min_size=db_pool_min, max_size=db_pool_max,
+        acquire_timeout=db_acquire_timeout, health_check_interval=db_health_check_interval,
+        history_cache=HistoryCache(
+            max_conversations=history_cache_conversations,
+            max_bytes=int(history_cache_mb * 1024 * 1024),
+            ttl=history_cache_ttl,
+            check_newest=history_cache_check,
+        ),
+    ) as db:
         await db.create_tables()
-        yield {'db': db}
+        admission = AdmissionControl(
+            max_concurrent=max_concurrent_chats, model_max_concurrent=model_max_concurrent,
+            model_limits=model_concurrency, max_queue=admission_queue_size, queue_timeout=admission_queue_timeout,
+        )
+        compactor = Compactor(
+            db, partial(summarize, admission), SYSTEM_PROMPT,
+            threshold_tokens=compact_threshold_tokens, keep_turns=compact_keep_turns,
+            tool_return_tokens=tool_return_max_tokens, summary_ttl=history_cache_ttl,
+        )
+        migration = asyncio.create_task(migrate_old_turns(db)) if message_migrate else None
+        # the writer drains its queue before the pool closes
+        async with TurnWriter.start(
+            db, max_batch=persist_batch_size, flush_interval=persist_flush_interval,
+            max_queue=persist_queue_size,
+        ) as writer:
+            # documents uploaded through another worker clear this worker's search cache too
+            async with db.listen(DOCUMENTS_CHANNEL, lambda _: retrieval_cache.invalidate()), UploadJobs.start(
+                max_workers=upload_workers, max_pending=upload_max_pending, publish=partial(publish_upload, db),
+            ) as uploads, create_http_client() as http_client:
+                register_gauges(db, writer, uploads, admission)
+                try:
+                    yield {
+                        'db': db, 'writer': writer, 'uploads': uploads, 'http_client': http_client,
+                        'compactor': compactor, 'admission': admission,
+                    }
+                finally:
+                    await compactor.close()
+                    if migration is not None:
+                        migration.cancel()
+                    shutdown_pdf_pool()
+                    close_backend()
+
+async def publish_upload(db: Database, job: UploadJob):
+    # any worker can answer GET /upload/<job_id>, the browser's polls are not sent to the same one
+    await db.save_upload_job(job.to_dict(), documents_changed=job.status == 'done')
+
+def register_gauges(db: Database, writer: TurnWriter, uploads: UploadJobs, admission: AdmissionControl):
+    registry.gauge(
+        'db_executor_queue_depth', 'Database calls waiting for a database thread', db.executor_queue_depth,
+    )
+    registry.gauge('db_pool_waiting', 'Requests waiting for a pooled database connection', db.pool_waiting)
+    registry.gauge('search_executor_queue_depth', 'Document searches waiting for a search thread', search_queue_depth)
+    registry.gauge('turn_writer_queue_depth', 'Turns waiting to be written', lambda: writer.stats()['queue_depth'])
+    registry.gauge('admission_in_flight', 'Chats holding an llm slot', lambda: admission.in_flight)
+    registry.gauge('admission_waiting', 'Chats waiting for an llm slot', lambda: admission.waiting)
+    registry.gauge('uploads_pending', 'Uploads queued or being processed', lambda: uploads.stats()['pending'])
+    if db.history_cache is not None:
+        registry.gauge('history_cache_bytes', 'Bytes of history held in the cache', lambda: db.history_cache.nbytes)
+
+async def migrate_old_turns(db: Database):
+    try:
+        migrated = await db.migrate_messages(message_migrate_batch)
+    except Exception:
+        # the old rows still read fine, try again on the next start
+        logging.exception('migrating stored messages failed')
+        return
+    if migrated:
+        logging.info('migrated %d turns to the current storage format', migrated)
 
 async def get_db(request: Request) -> Database:
     return request.state.db
 
+async def get_writer(request: Request) -> TurnWriter:
+    return request.state.writer
+
+async def get_uploads(request: Request) -> UploadJobs:
+    return request.state.uploads
+
+async def get_http_client(request: Request) -> AsyncClient:
+    return request.state.http_client
+
+async def get_compactor(request: Request) -> Compactor:
+    return request.state.compactor
+
+async def get_admission(request: Request) -> AdmissionControl:
+    return request.state.admission
+
 
 ## Create the FastAPI app
 app = fastapi.FastAPI(lifespan=lifespan)
-# logfire.instrument_fastapi(app)
+
+# traces only leave the process when a LOGFIRE_TOKEN is set
+logfire.configure(send_to_logfire='if-token-present', console=False)
+try:
+    logfire.instrument_fastapi(app)
+except Exception as exc:
+    # needs opentelemetry-instrumentation-fastapi, the app works without it
+    logging.warning('logfire fastapi instrumentation is off: %s', exc)
 
 
 ## Frontend routes
@@ -278,10 +512,17 @@ class ChatMessage(TypedDict):
     role: Literal['user', 'model']
     timestamp: str
     content: str
+    turn: NotRequired[int]
+
+def to_chat_message(m: ModelMessage, timestamp: datetime | None = None, turn: int | None = None) -> ChatMessage:
+    """Convert a message part to the browser format.
 
-def to_chat_message(m: ModelMessage) -> ChatMessage:
+    ``timestamp`` identifies a model response in the browser, streamed chunks of
+    the same response must all use the same one. ``turn`` is the ordinal of the
+    stored turn the message is from, if it has one.
+    """
     if isinstance(m, UserPromptPart):
-        return {
+        message: ChatMessage = {
             'role': 'user',
             'timestamp': m.timestamp.isoformat(),
             'content': m.content,
@@ -289,101 +530,312 @@ def to_chat_message(m: ModelMessage) -> ChatMessage:
 
     elif isinstance(m, TextPart):
 
-            return {
+            message = {
                 'role': 'model',
-                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'timestamp': (timestamp or datetime.now(timezone.utc)).isoformat(),
                 'content': '<b>Amanda\'s AI Response:</b><br>' + m.content,
             }
-    raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
-
+    else:
+        raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
+    if turn is not None:
+        message['turn'] = turn
+    return message
 
-@app.get('/chat/')
-async def get_chat(database: Database = Depends(get_db)) -> Response:
-    msgs = await database.get_messages()
 
-    body = b'\n'
-    for m in msgs:
+# conversation ids come from the browser, keep them to a sane size
+ConversationId = Annotated[str, fastapi.Query(min_length=1, max_length=64)]
 
-        if isinstance(m, ModelRequest):
-            for part in m.parts:
-                if isinstance(part, UserPromptPart):
-                    body += json.dumps(to_chat_message(part)).encode('utf-8') + b'\n'
+@app.get('/chat/')
+async def get_chat(
+    conversation_id: ConversationId = DEFAULT_CONVERSATION,
+    before: Annotated[int | None, fastapi.Query(ge=1)] = None,
+    limit: Annotated[int | None, fastapi.Query(ge=1, le=500)] = None,
+    database: Database = Depends(get_db),
+) -> StreamingResponse:
+    """Chat history as one json message per line, oldest first.
 
-        if isinstance(m, ModelResponse):
-            for part in m.parts:
-                if isinstance(part, TextPart):
-                    body += json.dumps(to_chat_message(part)).encode('utf-8') + b'\n'
+    Returns the ``limit`` turns before turn ordinal ``before``, the newest
+    turns without it. Each message carries the ``turn`` ordinal it belongs to,
+    the smallest one is the ``before`` of the next older page.
+    """
+    limit = limit or history_page_turns
+
+    async def iter_turns() -> AsyncIterator[CachedTurn]:
+        if before is None and database.history_cache is not None:
+            # the newest page is usually still in the history cache, and is put there
+            # if not, with several workers each one has a cache of its own to fill
+            for turn in await database.get_turns(conversation_id, last_turns=limit):
+                yield turn
+            return
+        async with aclosing(database.iter_turns(conversation_id, before, limit)) as turns:
+            async for turn in turns:
+                yield turn
+
+    async def stream_history():
+        async for turn in iter_turns():
+            lines = ndjson_lines(
+                to_chat_message(part, m.timestamp if isinstance(m, ModelResponse) else None, turn.ordinal)
+                for m in turn.messages
+                for part in m.parts
+                if isinstance(part, (UserPromptPart, TextPart))
+            )
+            if lines:
+                yield lines
 
-    resp = Response(
-        body,
-        media_type='text/plain',
-    )
-    return resp
+    return StreamingResponse(stream_history(), media_type='text/plain')
 
 @app.post('/chat/')
 async def post_chat(
-    prompt: Annotated[str, fastapi.Form()], database: Database = Depends(get_db)
-) -> StreamingResponse:
-    async def stream_messages():
-       
-        # stream the user prompt right away
-        yield (
-                json.dumps(
-                    {
-                        'role': 'user',
-                        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
-                        'content': prompt,
-                    }
-                ).encode('utf-8')
-                + b'\n'
+    request: Request,
+    prompt: Annotated[str, fastapi.Form()],
+    conversation_id: Annotated[str, fastapi.Form(min_length=1, max_length=64)] = DEFAULT_CONVERSATION,
+    database: Database = Depends(get_db),
+    writer: TurnWriter = Depends(get_writer),
+    http_client: AsyncClient = Depends(get_http_client),
+    compactor: Compactor = Depends(get_compactor),
+    admission: AdmissionControl = Depends(get_admission),
+) -> Response:
+    # clients sending faster than the rate limit are turned away first
+    wait = rate_limiter.take(request.client.host if request.client else 'unknown')
+    if wait:
+        return JSONResponse(
+            status_code=429, headers=retry_after_header(wait),
+            content={'message': 'Too many messages, please slow down.'},
         )
 
-        # get the full chat history so far to pass to llmn
-        messages = await database.get_messages()
-
-
+    intent = match_intent(prompt) if fast_path else None
+    summary = turns = messages = cache_key = cached = ticket = None
+    if intent is None:
+        # get the summary of older turns and the most recent window after it to pass to llm
+        with stage('history'):
+            summary = await compactor.summary(conversation_id)
+            turns = await database.get_turns(
+                conversation_id, last_turns=history_turns,
+                since_ordinal=summary.covers_ordinal if summary is not None else 0,
+            )
+            messages = compactor.history(summary, turns)
+        history_messages.observe(len(messages))
+        history_bytes.observe(sum(turn.nbytes for turn in turns))
+        history_tokens.observe(prompt_tokens(messages))
+
+        window = [turn.messages for turn in turns]
+        if summary is not None:
+            window.insert(0, summary.messages)
+        cache_key = response_cache.key(prompt, window, chat_model)
+        cached = response_cache.get(cache_key)
+
+        # only a chat going to the llm waits for a slot, up to the queue timeout,
+        # or tells the client to come back later (before the stream, so it can be a 503)
+        if cached is None:
+            try:
+                ticket = await admission.acquire(chat_model)
+            except Overloaded as e:
+                return JSONResponse(
+                    status_code=503, headers=retry_after_header(e.retry_after),
+                    content={'message': 'The assistant is busy right now, try again shortly.'},
+                )
 
-        # Construct dependencies
-        async with AsyncClient() as client:
+    async def stream_messages():
+        try:
+            # stream the user prompt right away
+            yield ndjson_line(
+                {
+                    'role': 'user',
+                    'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+                    'content': prompt,
+                }
+            )
 
+            turn_id = str(uuid.uuid4())
+
+            async def answer_locally(text: str):
+                # answered without the llm, stored like any other turn so the history stays complete
+                response = ModelResponse.from_text(content=text)
+                yield ndjson_line(to_chat_message(response.parts[0], response.timestamp))
+                new_messages = [ModelRequest(parts=[UserPromptPart(content=prompt)]), response]
+                await writer.submit(
+                    turn_id, conversation_id, ModelMessagesTypeAdapter.dump_json(new_messages), new_messages
+                )
+
+            if intent is not None:
+                text = INTENT_ANSWERS[intent]
+                # at least the prompt plus the tool text going in and coming back out
+                response_cache.record_intent(estimate_tokens(prompt) + 2 * estimate_tokens(text))
+                async for line in answer_locally(text):
+                    yield line
+                return
+
+            if cached is not None:
+                async for line in answer_locally(cached.text):
+                    yield line
+                return
+
+            # Construct dependencies, the tools share the pooled client from lifespan
             deps = Deps(
-                client=client
+                client=http_client
             )
-            result_final = await agent.run(prompt, message_history=messages, deps=deps)
-
-            text = result_final.data
-
-            m = ModelResponse.from_text(content=text, timestamp=datetime.now())
-            resp = m.parts[0]
-
-            yield json.dumps(to_chat_message(resp)).encode('utf-8') + b'\n'
-
-
-        # Save messages to the database
-        saved_messages_json = result_final.new_messages_json()
+            # stream the response as it is generated, each line holds the full text so far
+            # under the same timestamp so the browser replaces the message in place
+            text = None
+            started = time.perf_counter()
+            with stage('llm'):
+                async with agent.run_stream(prompt, message_history=messages, deps=deps) as result_final:
+                    async for text in result_final.stream_text(debounce_by=0.01):
+                        if text is not None and started is not None:
+                            stage_seconds.observe(time.perf_counter() - started, stage='llm_first_token')
+                            started = None
+                        m = ModelResponse.from_text(content=text, timestamp=result_final.timestamp())
+                        resp = m.parts[0]
+
+                        yield ndjson_line(to_chat_message(resp, m.timestamp))
+
+            usage = result_final.usage()
+            llm_requests.inc(usage.requests)
+            llm_tokens.inc(usage.request_tokens or 0, kind='request')
+            llm_tokens.inc(usage.response_tokens or 0, kind='response')
+
+
+            if text is not None:
+                response_cache.put(cache_key, text, result_final.usage().total_tokens or 0, result_final.new_messages())
+
+            # Save messages to the database
+            saved_messages_json = result_final.new_messages_json()
+
+            # queue the new messages for the database, the writer saves them in the background
+            with stage('persist_submit'):
+                await writer.submit(turn_id, conversation_id, saved_messages_json, result_final.new_messages())
+
+            # summarize older turns on a background task if the history got too long
+            new_turn = CachedTurn(turn_id, None, result_final.new_messages(), len(saved_messages_json))
+            compactor.maybe_compact(conversation_id, summary, [*turns, new_turn])
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    # the ticket is released again after the response in case the stream never started
+    return StreamingResponse(
+        stream_messages(), media_type='text/plain',
+        background=BackgroundTask(ticket.release) if ticket is not None else None,
+    )
 
-        turn_id = str(uuid.uuid4())
+@app.get('/metrics')
+async def metrics() -> Response:
+    """Prometheus text format metrics of this worker process."""
+    return Response(registry.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/health/live')
+async def liveness() -> dict[str, str]:
+    """The process is up and serving requests."""
+    return {'status': 'ok'}
+
+@app.get('/health/ready')
+async def readiness(database: Database = Depends(get_db)) -> JSONResponse:
+    """Ready to chat when the database answers, documents are reported but optional."""
+    database_ok = await database.ping()
+    documents = await run_in_threadpool(backend_status)
+    status = 'unavailable' if not database_ok else 'ready' if documents['ready'] else 'degraded'
+    return JSONResponse(
+        status_code=200 if database_ok else 503,
+        content={'status': status, 'database': database_ok, 'documents': documents},
+    )
 
-        # add new messages to the database
-        await database.add_messages(turn_id, saved_messages_json)
+@app.get('/stats/')
+async def get_stats(
+    database: Database = Depends(get_db), writer: TurnWriter = Depends(get_writer),
+    uploads: UploadJobs = Depends(get_uploads), compactor: Compactor = Depends(get_compactor),
+    admission: AdmissionControl = Depends(get_admission),
+) -> dict[str, Any]:
+    """Counters of the in-process caches and queues, used to size them."""
+    stats: dict[str, Any] = {
+        'turn_writer': writer.stats(),
+        'uploads': uploads.stats(),
+        'retrieval_cache': retrieval_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'geocode_cache': geocode_cache.stats(),
+        'weather_cache': weather_cache.stats(),
+        'compaction': compactor.stats(),
+        'admission': admission.stats(),
+        'rate_limit': rate_limiter.stats(),
+    }
+    if database.history_cache is not None:
+        stats['history_cache'] = database.history_cache.stats()
+    return stats
 
-    return StreamingResponse(stream_messages(), media_type='text/plain')
+def process_upload(path: str, replaces: str | None, job: UploadJob) -> str:
+    """Parse and ingest one PDF, runs on an upload worker thread.
 
-@app.post("/upload/")
-async def upload_file(file: UploadFile = File(...)):
+    Pages stream straight from the parser into chunking and the Weaviate
+    batch, the spooled upload at ``path`` is removed when done. ``replaces``
+    is the source id of an earlier upload to remove, see ingest_text_to_weaviate.
+    """
+    def on_page(parsed: int, total: int):
+        job.pages_parsed, job.pages_total = parsed, total
+
+    def on_chunk(added: int):
+        job.status = 'embedding'
+        job.chunks_embedded = added
+
+    stage_seconds.observe(time.time() - job.created_at, stage='upload_queue_wait')
+    try:
+        # the same file uploaded again is found by its hash and not parsed at all
+        source_id = file_hash(path)
+        if document_stored(source_id):
+            job.duplicate = True
+            if replaces and replaces != source_id:
+                delete_document(replaces)
+            return source_id
+        job.status = 'parsing'
+        with stage('upload_ingest', filename=job.filename):
+            pages = extract_pages_from_pdf(path, on_page=on_page)
+            return ingest_text_to_weaviate(
+                pages, job.filename, on_chunk=on_chunk, source_id=source_id, replaces=replaces
+            )
+    finally:
+        os.unlink(path)
+
+@app.post("/upload/", status_code=202)
+async def upload_file(
+    file: UploadFile = File(...),
+    # the source_id of an earlier upload this one replaces, files are never replaced by name
+    replaces: Annotated[str | None, Form(max_length=64)] = None,
+    uploads: UploadJobs = Depends(get_uploads),
+):
     if file.content_type != "application/pdf":
         return JSONResponse(status_code=400, content={"message": "Invalid file type. Only PDFs are allowed."})
 
-    # Read the file content
-    content = await file.read()
-
-    # Convert PDF content to text
-    text_content = extract_text_from_pdf(content)
+    # Copy the spooled upload to a file the workers can open by path
+    with stage('upload_spool'), tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as spooled:
+        await run_in_threadpool(shutil.copyfileobj, file.file, spooled)
+
+    # Parse and ingest in the background, the browser polls the job for progress
+    try:
+        job = uploads.submit(file.filename or "", partial(process_upload, spooled.name, replaces or None))
+    except TooManyUploads:
+        os.unlink(spooled.name)
+        return JSONResponse(
+            status_code=503, headers={"Retry-After": "10"},
+            content={"message": "Too many uploads in progress, try again shortly."},
+        )
 
-    # Ingest the text content to Weaviate
-    ingest_text_to_weaviate(text_content)
+    return {
+        "filename": file.filename,
+        "job_id": job.id,
+        "status_url": f"/upload/{job.id}",
+        "message": "File uploaded, processing started",
+    }
 
-    return {"filename": file.filename, "message": "File uploaded successfully"}
+@app.get("/upload/{job_id}")
+async def upload_status(
+    job_id: str, uploads: UploadJobs = Depends(get_uploads), database: Database = Depends(get_db),
+):
+    job = uploads.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    # the upload runs on another worker, it stores its progress in the database
+    stored = await database.get_upload_job(job_id)
+    if stored is None:
+        return JSONResponse(status_code=404, content={"message": "Unknown upload job."})
+    return stored
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Splits extracted document text into overlapping chunks
+#      so each vector covers a passage and not a whole document
+
+
+from __future__ import annotations as _annotations
+
+import re
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+
+# end of a sentence: . ! or ? followed by whitespace, or a blank line
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+
+@dataclass
+class Chunk:
+    """A passage of a document."""
+
+    text: str
+    page: int  # page number the passage is on, starting at 1
+    index: int  # position of the chunk in the whole document
+
+
+def split_sentences(text: str) -> list[str]:
+    sentences = (s.strip() for s in SENTENCE_END.split(text))
+    return [' '.join(s.split()) for s in sentences if s]
+
+
+def chunk_pages(
+        pages: Iterable[tuple[int, str]], chunk_size: int = 1000, overlap: int = 200
+) -> Iterator[Chunk]:
+    """Chunk the text of each page.
+
+    Chunks are built from whole sentences up to ``chunk_size`` characters and
+    never cross a page, so every chunk has exactly one page number. The last
+    sentences of a chunk, up to ``overlap`` characters, are repeated at the
+    start of the next one so a passage cut in two can still be found.
+    Sentences longer than a chunk are split on character boundaries.
+
+    Args:
+        pages: (page number, text) pairs in document order.
+        chunk_size: Maximum characters per chunk.
+        overlap: Characters of trailing sentences carried into the next chunk.
+    """
+    if overlap >= chunk_size:
+        raise ValueError('overlap must be smaller than chunk_size')
+
+    index = 0
+    for page, text in pages:
+        current: list[str] = []
+        length = 0
+        fresh = False  # current holds more than the overlap of the previous chunk
+        for sentence in split_sentences(text):
+            # sentences too long to ever fit get cut up
+            pieces = [sentence[i:i + chunk_size] for i in range(0, len(sentence), chunk_size)]
+            for piece in pieces:
+                if current and length + 1 + len(piece) > chunk_size:
+                    yield Chunk(' '.join(current), page, index)
+                    index += 1
+                    current, length = _overlap_tail(current, overlap)
+                    fresh = False
+                    if current and length + 1 + len(piece) > chunk_size:
+                        current, length = [], 0
+                current.append(piece)
+                length += len(piece) + (1 if length else 0)
+                fresh = True
+        if fresh:
+            yield Chunk(' '.join(current), page, index)
+            index += 1
+
+
+def _overlap_tail(sentences: list[str], overlap: int) -> tuple[list[str], int]:
+    tail: list[str] = []
+    length = 0
+    for sentence in reversed(sentences):
+        if length + len(sentence) > overlap:
+            break
+        tail.insert(0, sentence)
+        length += len(sentence) + (1 if len(tail) > 1 else 0)
+    return tail, length
@@ -0,0 +1,196 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Keeps the history sent to the llm small: once a conversation gets long
+#      its older turns are summarized in the background and the llm gets the
+#      summary plus the recent turns, with old tool results cut short
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import logging
+from dataclasses import replace
+from typing import Any, Awaitable, Callable
+
+import logfire
+from pydantic_ai.messages import ModelMessage, ModelRequest, SystemPromptPart, ToolReturnPart
+
+from caching import TTLCache
+from database import Database, Summary
+from history_cache import CachedTurn
+from response_cache import history_text
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+SUMMARY_PREFIX = 'Summary of the earlier conversation:\n'
+TRUNCATED = ' [truncated]'
+
+
+def truncate_tool_returns(messages: list[ModelMessage], max_tokens: int) -> list[ModelMessage]:
+    """Copies of ``messages`` with tool results longer than ``max_tokens`` cut short.
+
+    The stored messages are shared with the history cache and never changed.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    truncated: list[ModelMessage] = []
+    for message in messages:
+        if isinstance(message, ModelRequest) and any(
+            isinstance(part, ToolReturnPart) and len(part.model_response_str()) > max_chars
+            for part in message.parts
+        ):
+            parts = [
+                replace(part, content=part.model_response_str()[:max_chars] + TRUNCATED)
+                if isinstance(part, ToolReturnPart) and len(part.model_response_str()) > max_chars else part
+                for part in message.parts
+            ]
+            message = replace(message, parts=parts)
+        truncated.append(message)
+    return truncated
+
+
+def prompt_tokens(messages: list[ModelMessage]) -> int:
+    """Estimated tokens of the history the llm is sent."""
+    return sum(estimate_tokens(content) for _, content in history_text(messages))
+
+
+def transcript(messages: list[ModelMessage]) -> str:
+    """The conversation as text for the summarizer, the agent's own instructions left out."""
+    return '\n'.join(
+        f'{kind}: {content}' for kind, content in history_text(messages)
+        if kind != 'system' or content.startswith(SUMMARY_PREFIX)
+    )
+
+
+class Compactor:
+    """Builds the history sent to the llm and summarizes conversations that outgrow it.
+
+    The llm gets the system prompt, the newest summary and the turns after
+    it. Tool results of every turn but the last are cut to
+    ``tool_return_tokens``, the answers built from them are still there.
+    When that history is over ``threshold_tokens`` the turns before the last
+    ``keep_turns`` (at least ``keep_turns`` of them) are summarized by
+    ``summarize`` on a background task and the summary is stored as a turn
+    of its own. The chat request never
+    waits for it, the next turns pick the summary up when it is done.
+    """
+
+    def __init__(
+            self, database: Database, summarize: Callable[[str], Awaitable[str]], system_prompt: str,
+            threshold_tokens: int = 6000, keep_turns: int = 6, tool_return_tokens: int = 200,
+            summary_ttl: float = 300.0,
+    ):
+        self.database = database
+        self.summarize = summarize
+        self.system_prompt = system_prompt
+        self.threshold_tokens = threshold_tokens
+        self.keep_turns = keep_turns
+        self.tool_return_tokens = tool_return_tokens
+        self.compactions = 0
+        self.failures = 0
+        self.turns_compacted = 0
+        # (summary,) so that conversations without one are cached too
+        self._summaries: TTLCache[str, tuple[Summary | None]] = TTLCache(10000, summary_ttl)
+        self._tasks: dict[str, asyncio.Task[None]] = {}
+
+    async def summary(self, conversation_id: str) -> Summary | None:
+        cached = self._summaries.get(conversation_id)
+        if cached is None:
+            cached = (await self.database.get_summary(conversation_id),)
+            self._summaries.set(conversation_id, cached)
+        return cached[0]
+
+    def history(self, summary: Summary | None, turns: list[CachedTurn]) -> list[ModelMessage]:
+        """The messages to send to the llm for the summary and the turns after it."""
+        messages: list[ModelMessage] = []
+        for i, turn in enumerate(turns):
+            stale = i < len(turns) - 1
+            messages.extend(truncate_tool_returns(turn.messages, self.tool_return_tokens) if stale else turn.messages)
+
+        # the agent only adds its system prompt to an empty history, once the
+        # first turn is summarized or out of the window it has to be put back
+        has_system_prompt = bool(messages) and isinstance(messages[0], ModelRequest) and any(
+            isinstance(part, SystemPromptPart) for part in messages[0].parts
+        )
+        if summary is not None:
+            summary_parts = [part for message in summary.messages for part in message.parts]
+            messages.insert(0, ModelRequest(parts=[SystemPromptPart(content=self.system_prompt), *summary_parts]))
+        elif messages and not has_system_prompt:
+            messages.insert(0, ModelRequest(parts=[SystemPromptPart(content=self.system_prompt)]))
+        return messages
+
+    def maybe_compact(self, conversation_id: str, summary: Summary | None, turns: list[CachedTurn]) -> bool:
+        """Start summarizing the older ``turns`` if the history is too long, returns if it started.
+
+        ``turns`` is the history the llm was just sent plus the new turn.
+        """
+        if self.threshold_tokens <= 0 or conversation_id in self._tasks:
+            return False
+        older = turns[:-self.keep_turns] if self.keep_turns > 0 else turns
+        # a few turns at a time, not a new summary on every turn once a conversation is long
+        if not older or len(older) < self.keep_turns:
+            return False
+        # turns still queued for the database have no ordinal to record as covered yet
+        if any(turn.ordinal is None for turn in older):
+            return False
+        if prompt_tokens(self.history(summary, turns)) <= self.threshold_tokens:
+            return False
+        task = asyncio.create_task(self._compact(conversation_id, summary, older[-1].ordinal))
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+        return True
+
+    async def _compact(self, conversation_id: str, summary: Summary | None, cut: int) -> None:
+        """Summarize the previous summary plus every turn after it up to ordinal ``cut``."""
+        try:
+            with logfire.span('compact conversation', conversation_id=conversation_id, cut=cut):
+                # the llm only got the last HISTORY_TURNS, the turns between the previous
+                # summary and that window have to be summarized too
+                turns = [
+                    turn for turn in await self.database.get_turns(
+                        conversation_id, last_turns=None,
+                        since_ordinal=summary.covers_ordinal if summary is not None else 0,
+                    )
+                    if turn.ordinal is not None and turn.ordinal <= cut
+                ]
+                if not turns:
+                    return
+                text = transcript(truncate_tool_returns(
+                    [message for turn in turns for message in turn.messages], self.tool_return_tokens,
+                ))
+                if summary is not None:
+                    text = transcript(summary.messages) + '\n' + text
+                summary_text = await self.summarize(text)
+                new_summary = await self.database.add_summary(
+                    conversation_id, turns[-1].ordinal,
+                    [ModelRequest(parts=[SystemPromptPart(content=SUMMARY_PREFIX + summary_text)])],
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # the full history is still there, the next turn tries again
+            logging.exception('summarizing conversation %s failed', conversation_id)
+            self.failures += 1
+            return
+        self._summaries.set(conversation_id, (new_summary,))
+        self.compactions += 1
+        self.turns_compacted += len(turns)
+
+    async def close(self) -> None:
+        """Stop the running summaries, they are redone when the conversation continues."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'running': len(self._tasks),
+            'compactions': self.compactions,
+            'failures': self.failures,
+            'turns_compacted': self.turns_compacted,
+            'summaries': self._summaries.stats(),
+        }
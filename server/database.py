@@ -12,15 +12,21 @@
 from __future__ import annotations as _annotations
 
 import asyncio
+import json
+import logging
+import time
+import uuid
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from collections.abc import AsyncIterator
 from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
-from typing import Annotated, Any, Callable, Literal, LiteralString, ParamSpec, TypeVar
+from typing import Annotated, Any, Callable, Literal, ParamSpec, TypeVar
 import sys
 import os
 from fastapi import Depends, Request
@@ -39,10 +45,17 @@ from pydantic_ai.messages import (
 import logfire
 from collections import deque
 
+from history_cache import CachedTurn, HistoryCache, select_turns
+from message_codec import current_version, decode_messages, encode_messages
+from metrics import stage_seconds
+
 sys.path.append(str(Path(__file__).parent.parent))
 
 THIS_DIR = Path(__file__).parent
 
+# conversation used for rows written before turns were partitioned by conversation
+DEFAULT_CONVERSATION = 'default'
+
 MessageTypeAdapter: TypeAdapter[ModelMessage] = TypeAdapter(
     Annotated[ModelMessage, Field(discriminator='kind')]
 )
@@ -50,46 +63,216 @@ P = ParamSpec('P')
 R = TypeVar('R')
 
 
+# turns.ordinal is a SERIAL, nothing is stored past this
+MAX_ORDINAL = 2**31 - 1
+
+# advisory lock key held while the tables are created, every worker process does it on startup
+SCHEMA_LOCK_ID = 0x616d616e6461
+
+# NOTIFY channel of documents added or removed, workers clear their search caches on it
+DOCUMENTS_CHANNEL = 'documents_changed'
+# seconds before a dropped LISTEN connection is opened again
+LISTEN_RETRY_INTERVAL = 5.0
+# finished upload jobs are kept this long for polling
+UPLOAD_JOB_RETENTION = '1 day'
+
+# the newest LIMIT turns on one side of an ordinal, picked first (index scan on
+# turns(conversation_id, ordinal)), then only the messages of those turns are joined
+TURNS_WINDOW_SQL = """
+SELECT window_turns.id AS turn_id, window_turns.ordinal AS turn_ordinal, messages.message_list,
+       window_turns.version, messages.ordinal AS message_ordinal
+FROM (
+    SELECT id, ordinal, version FROM turns
+    WHERE conversation_id = %s AND kind = 'chat' AND ordinal {direction} %s
+    ORDER BY ordinal DESC
+    LIMIT %s
+) AS window_turns
+JOIN messages ON messages.turn_id = window_turns.id
+ORDER BY turn_ordinal ASC, message_ordinal ASC;
+"""
+
+
+def _group_turns(rows: list[tuple]) -> list[CachedTurn]:
+    """Decode (turn id, ordinal, blob, version, ...) rows, one turn can span several rows."""
+    turns: list[CachedTurn] = []
+    for row in rows:
+        blob = decode_messages(bytes(row[2]), row[3])
+        message_list = ModelMessagesTypeAdapter.validate_json(blob)
+        if turns and turns[-1].turn_id == str(row[0]):
+            turns[-1].messages.extend(message_list)
+            turns[-1].nbytes += len(blob)
+        else:
+            turns.append(CachedTurn(str(row[0]), row[1], message_list, len(blob)))
+    return turns
+
+
+@dataclass
+class NewTurn:
+    """A turn waiting to be written, see `Database.add_turns`."""
+
+    turn_id: str
+    conversation_id: str
+    message_list: bytes
+
+
+@dataclass
+class Summary:
+    """A stored summary of the turns of a conversation up to ``covers_ordinal``."""
+
+    turn_id: str
+    covers_ordinal: int
+    messages: list[ModelMessage]
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within the acquire timeout."""
+
+
 @dataclass
 class Database:
     """Database to store chat messages in PostgreSQL.
+
+    Connections come from a sized pool and every call checks one out for the
+    duration of a single executor hop, so concurrent requests no longer queue
+    behind one socket.
     """
 
-    con: psycopg2.extensions.connection
+    pool: ThreadedConnectionPool
     _loop: asyncio.AbstractEventLoop
     _executor: ThreadPoolExecutor
+    _slots: asyncio.Semaphore
+    acquire_timeout: float = 10.0
+    health_check_interval: float = 30.0
+    history_cache: HistoryCache | None = None
+    _last_used: dict[int, float] = field(default_factory=dict)
+    # counted here for the metrics, see executor_queue_depth and pool_waiting
+    threads: int = 10
+    _in_executor: int = 0
+    _waiting: int = 0
+    # how to open a connection outside the pool, for LISTEN
+    _connect_kwargs: dict[str, Any] = field(default_factory=dict)
 
     @classmethod
     @asynccontextmanager
     async def connect(
-            cls, dbname: str, user: str, password: str, host: str, port: int
+            cls, dbname: str, user: str, password: str, host: str, port: int,
+            min_size: int = 1, max_size: int = 10,
+            acquire_timeout: float = 10.0, health_check_interval: float = 30.0,
+            history_cache: HistoryCache | None = None,
     ) -> AsyncIterator[Database]:
-        with logfire.span('connect to DB'):
+        with logfire.span('connect to DB', min_size=min_size, max_size=max_size):
             loop = asyncio.get_event_loop()
-            executor = ThreadPoolExecutor(max_workers=1)
-            con = await loop.run_in_executor(
-                executor, partial(psycopg2.connect, dbname=dbname, user=user, password=password, host=host, port=port)
+            # one thread per connection so a checked out connection never waits on a thread
+            executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix='db')
+            pool = await loop.run_in_executor(
+                executor, partial(
+                    ThreadedConnectionPool, min_size, max_size,
+                    dbname=dbname, user=user, password=password, host=host, port=port
+                )
+            )
+            slf = cls(
+                pool, loop, executor, asyncio.Semaphore(max_size),
+                acquire_timeout=acquire_timeout, health_check_interval=health_check_interval,
+                history_cache=history_cache, threads=max_size,
+                _connect_kwargs=dict(dbname=dbname, user=user, password=password, host=host, port=port),
             )
-            slf = cls(con, loop, executor)
             try:
                 yield slf
             finally:
-                await slf._asyncify(con.close)
+                await loop.run_in_executor(executor, pool.closeall)
+                executor.shutdown(wait=True)
 
-    async def _asyncify(
-            self, func: Callable[..., R], *args: Any, **kwargs: Any
-    ) -> R:
-        return await self._loop.run_in_executor(
-            self._executor,
-            partial(func, *args, **kwargs),
-        )
+    ## Connection checkout
 
-    async def create_tables(self):
-        cur = await self._asyncify(self.con.cursor)
+    def _checkout(self) -> psycopg2.extensions.connection:
+        """Take a connection from the pool, replacing it if it has gone bad."""
+        con = self.pool.getconn()
+        idle = time.monotonic() - self._last_used.get(id(con), 0.0)
+        if con.closed or (idle > self.health_check_interval and not self._is_healthy(con)):
+            self._last_used.pop(id(con), None)
+            self.pool.putconn(con, close=True)
+            con = self.pool.getconn()
+        return con
+
+    def _checkin(self, con: psycopg2.extensions.connection) -> None:
+        if not con.closed and con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # never hand a connection with an open transaction to the next caller
+            con.rollback()
+        self._last_used[id(con)] = time.monotonic()
+        self.pool.putconn(con, close=bool(con.closed))
+
+    @staticmethod
+    def _is_healthy(con: psycopg2.extensions.connection) -> bool:
         try:
-            await self._asyncify(cur.execute, "CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";")
-            await self._asyncify(cur.execute, "CREATE SEQUENCE IF NOT EXISTS message_ordinal_seq;")
-            await self._asyncify(cur.execute, """
+            with con.cursor() as cur:
+                cur.execute('SELECT 1')
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    async def _acquire_slot(self) -> None:
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f'no database connection available after {self.acquire_timeout}s') from None
+        finally:
+            self._waiting -= 1
+
+    async def _in_thread(self, func: Callable[..., R], *args: Any) -> R:
+        """Run ``func(*args)`` on a database thread."""
+        self._in_executor += 1
+        try:
+            return await self._loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._in_executor -= 1
+
+    async def _run(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """Run ``func(con, *args)`` on a pooled connection in a single executor hop."""
+        await self._acquire_slot()
+        try:
+            return await self._in_thread(partial(self._with_connection, func, *args, **kwargs))
+        finally:
+            self._slots.release()
+
+    def _with_connection(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        con = self._checkout()
+        try:
+            return func(con, *args, **kwargs)
+        finally:
+            self._checkin(con)
+
+    def executor_queue_depth(self) -> int:
+        """Calls waiting for a database thread, for the metrics."""
+        # the executor starts a thread per call up to its limit, the rest queue
+        return max(0, self._in_executor - self.threads)
+
+    def pool_waiting(self) -> int:
+        """Callers waiting for a connection slot, for the metrics."""
+        return self._waiting
+
+    ## Queries
+
+    async def ping(self) -> bool:
+        """True if a pooled connection answers, for the readiness check."""
+        try:
+            return await self._run(self._is_healthy)
+        except (PoolTimeout, psycopg2.Error):
+            return False
+
+    async def create_tables(self):
+        await self._run(self._create_tables)
+
+    @staticmethod
+    def _create_tables(con: psycopg2.extensions.connection) -> None:
+        with con.cursor() as cur:
+            # one worker at a time, concurrent CREATE ... IF NOT EXISTS can still fail on
+            # the catalog, the lock goes with the transaction at the commit below
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK_ID,))
+            cur.execute("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";")
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS message_ordinal_seq;")
+            cur.execute("""
             CREATE TABLE IF NOT EXISTS turns (
                 /* id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),*/
                 id UUID PRIMARY KEY,
@@ -106,86 +289,407 @@ class Database:
                 ordinal INTEGER DEFAULT nextval('message_ordinal_seq')
                         
             );
+            ALTER TABLE turns ADD COLUMN IF NOT EXISTS conversation_id TEXT NOT NULL DEFAULT 'default';
+            DROP INDEX IF EXISTS turns_ordinal_idx;
+            CREATE INDEX IF NOT EXISTS turns_conversation_ordinal_idx ON turns (conversation_id, ordinal);
+            CREATE INDEX IF NOT EXISTS messages_turn_ordinal_idx ON messages (turn_id, ordinal);
+            /* 'chat' turns are shown and sent to the llm, a 'summary' turn stands in for
+               the chat turns up to covers_ordinal, see compaction.py */
+            ALTER TABLE turns ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'chat';
+            ALTER TABLE turns ADD COLUMN IF NOT EXISTS covers_ordinal INTEGER;
+            CREATE INDEX IF NOT EXISTS turns_summary_idx ON turns (conversation_id, ordinal) WHERE kind = 'summary';
+            /* progress of uploads, so any worker can answer GET /upload/<job_id>, see upload_jobs.py */
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id TEXT PRIMARY KEY,
+                job JSONB NOT NULL,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );
             """)
-            await self._asyncify(self.con.commit)
-        finally:
-            await self._asyncify(cur.close)
+            cur.execute(
+                "DELETE FROM upload_jobs WHERE updated_at < NOW() - %s::interval;", (UPLOAD_JOB_RETENTION,)
+            )
+        con.commit()
+
+    async def add_messages(
+            self, turn: str, alr_messages: bytes, conversation_id: str = DEFAULT_CONVERSATION,
+            decoded: list[ModelMessage] | None = None,
+    ):
+        """Store the messages of one turn.
 
+        ``decoded`` can be passed when the caller already has the messages as
+        objects, it saves decoding the blob again for the history cache.
+        """
+        ordinals = await self.add_turns([NewTurn(turn, conversation_id, alr_messages)])
+        if self.history_cache is not None:
+            if decoded is None:
+                decoded = ModelMessagesTypeAdapter.validate_json(alr_messages)
+            self.history_cache.append(
+                conversation_id, CachedTurn(turn, ordinals[turn], decoded, len(alr_messages))
+            )
 
+    async def add_turns(self, turns: list[NewTurn]) -> dict[str, int]:
+        """Store many turns in one transaction, returns the ordinal of each turn id."""
+        return await self._run(self._add_turns, turns)
 
-    async def add_messages(self, turn: str, alr_messages: bytes):
-        cur = await self._asyncify(self.con.cursor)
-        version = '0.0.1'
+    @staticmethod
+    def _add_turns(con: psycopg2.extensions.connection, turns: list[NewTurn]) -> dict[str, int]:
+        # compressed here on the database thread, not on the event loop
+        version = current_version()
+        blobs = [encode_messages(t.message_list, version)[0] for t in turns]
         try:
-            await self._asyncify(cur.execute, 'BEGIN TRANSACTION')
-            try:
-                await self._asyncify(
-                    cur.execute,
-                    'INSERT INTO turns (id, version) VALUES (%s, %s) RETURNING id;',
-                    (turn, version)
+            with con.cursor() as cur:
+                # multi-row inserts, one round trip per table however many turns there are
+                rows = execute_values(
+                    cur,
+                    'INSERT INTO turns (id, conversation_id, version) VALUES %s RETURNING id, ordinal;',
+                    [(t.turn_id, t.conversation_id, version) for t in turns],
+                    fetch=True,
                 )
-                turn_id = (await self._asyncify(cur.fetchone))[0]
+                ordinals = {str(turn_id): ordinal for turn_id, ordinal in rows}
 
-                await self._asyncify(
-                    cur.execute,
-                    'INSERT INTO messages (turn_id, message_list) VALUES (%s, %s);',
-                    (turn_id, psycopg2.Binary(alr_messages))
+                execute_values(
+                    cur,
+                    'INSERT INTO messages (turn_id, message_list) VALUES %s;',
+                    [(t.turn_id, psycopg2.Binary(blob)) for t, blob in zip(turns, blobs)],
                 )
+            con.commit()
+            return ordinals
+        except Exception as e:
+            con.rollback()
+            raise e
+
+    async def get_messages(
+            self, conversation_id: str = DEFAULT_CONVERSATION,
+            last_turns: int | None = None, since_ordinal: int = 0
+    ) -> list[ModelMessage]:
+        """Get the chat history of one conversation, oldest first.
+
+        Args:
+            conversation_id: The conversation to read.
+            last_turns: Only return the most recent ``last_turns`` turns, ``None`` for all of them.
+            since_ordinal: Only return turns with an ordinal greater than this.
+        """
+        turns = await self.get_turns(conversation_id, last_turns, since_ordinal)
+        return [message for turn in turns for message in turn.messages]
+
+    async def get_turns(
+            self, conversation_id: str = DEFAULT_CONVERSATION,
+            last_turns: int | None = None, since_ordinal: int = 0
+    ) -> list[CachedTurn]:
+        """Same window as `get_messages` but keeps the messages grouped by turn."""
+        if self.history_cache is not None:
+            cached = self.history_cache.get(conversation_id, last_turns, since_ordinal)
+            if cached is not None and self.history_cache.check_newest:
+                # one index lookup instead of the whole window, another worker process
+                # may have stored turns of this conversation since it was cached
+                newest = await self._run(self._newest_ordinal, conversation_id)
+                if newest is not None and newest > self.history_cache.newest_stored(conversation_id):
+                    self.history_cache.drop_stored(conversation_id)
+                    cached = None
+            if cached is not None:
+                return cached
+
+        with stage_seconds.time(stage='db_read'):
+            turns = await self._run(self._get_turns, conversation_id, last_turns, since_ordinal)
+
+        if self.history_cache is not None:
+            if last_turns is None or len(turns) < last_turns:
+                covers_after = since_ordinal  # we got everything after since_ordinal
+            else:
+                covers_after = turns[0].ordinal - 1 if turns else since_ordinal
+            # the prompt also needs the turns still queued for the database
+            merged = self.history_cache.put(conversation_id, turns, covers_after)
+            return select_turns(merged, last_turns, since_ordinal)
+        return turns
 
-                await self._asyncify(self.con.commit)
-            except Exception as e:
-                await self._asyncify(self.con.rollback)
-                raise e
+    @staticmethod
+    def _newest_ordinal(con: psycopg2.extensions.connection, conversation_id: str) -> int | None:
+        with con.cursor() as cur:
+            cur.execute(
+                "SELECT max(ordinal) FROM turns WHERE conversation_id = %s AND kind = 'chat';",
+                (conversation_id,),
+            )
+            return cur.fetchone()[0]
+
+    async def iter_turns(
+            self, conversation_id: str = DEFAULT_CONVERSATION,
+            before: int | None = None, limit: int = 20, fetch_size: int = 50,
+    ) -> AsyncIterator[CachedTurn]:
+        """The ``limit`` turns before ordinal ``before`` (the newest without it), oldest first.
+
+        Rows come through a server-side cursor ``fetch_size`` at a time and are
+        decoded on the database thread, so the first turns can be sent before
+        the rest are read. The connection is held until the iteration ends.
+        """
+        await self._acquire_slot()
+        con = cur = None
+        release_slot = True
+        try:
+            # a task of its own, so a cancel here does not lose the connection it gets
+            opening = asyncio.ensure_future(self._in_thread(
+                self._open_cursor, TURNS_WINDOW_SQL.format(direction='<'),
+                (conversation_id, MAX_ORDINAL if before is None else before, limit),
+            ))
+            try:
+                con, cur = await asyncio.shield(opening)
+            except asyncio.CancelledError:
+                # the thread still gets a connection, it goes back to the pool once it has
+                release_slot = False
+                opening.add_done_callback(self._release_opened)
+                raise
+            held: CachedTurn | None = None  # the last turn of a batch may continue in the next
+            while True:
+                batch = await self._in_thread(self._fetch_turns, cur, fetch_size)
+                if not batch:
+                    break
+                if held is not None:
+                    if batch[0].turn_id == held.turn_id:
+                        batch[0].messages[:0] = held.messages
+                        batch[0].nbytes += held.nbytes
+                    else:
+                        yield held
+                for turn in batch[:-1]:
+                    yield turn
+                held = batch[-1]
+            if held is not None:
+                yield held
         finally:
-            await self._asyncify(cur.close)
-
-    async def get_messages(self) -> list[ModelMessage]:
-        c = await self._asyncify(
-            self._execute, 'SELECT message_list FROM messages order by id asc'
-        )
-        rows = await self._asyncify(c.fetchall)
-        messages: list[ModelMessage] = []
-        for row in rows:
-            messages.extend(ModelMessagesTypeAdapter.validate_json(row[0].decode("utf-8")))
-        return messages
-
-    async def _get_messages(self) -> list[ModelMessage]:
-        cur = await self._asyncify(self.con.cursor)
+            if con is not None:
+                await self._in_thread(self._release_cursor, con, cur)
+            if release_slot:
+                self._slots.release()
+
+    def _open_cursor(self, sql: str, params: tuple) -> tuple[psycopg2.extensions.connection, Any]:
+        """Check out a connection and run ``sql`` on a named cursor, the connection goes back if that fails."""
+        con = self._checkout()
         try:
-            await self._asyncify(cur.execute, """
-            SELECT turns.id AS turn_id, turns.ordinal AS turn_ordinal, messages.message_list, messages.ordinal AS message_ordinal, 'alr' AS message_type
-            FROM messages
-            JOIN turns ON messages.turn_id = turns.id
-            ORDER BY turn_ordinal ASC, message_ordinal ASC;
-            """)
-            rows = await self._asyncify(cur.fetchall)
-            messages: list[ModelMessage] = []
-            for row in rows:
-                message_list = ModelMessagesTypeAdapter.validate_json(bytes(row[2]))
-                for message in message_list:
-                    messages.append(message)
-            return messages
+            # a named cursor lives on the server, rows are only sent as they are fetched
+            cur = con.cursor(name=f'history_{uuid.uuid4().hex}')
+            cur.execute(sql, params)
+            return con, cur
+        except BaseException:
+            self._checkin(con)
+            raise
+
+    def _release_opened(self, opening: asyncio.Future) -> None:
+        """Done callback of an `_open_cursor` whose caller was cancelled while it ran."""
+        if opening.cancelled() or opening.exception() is not None:
+            self._slots.release()
+            return
+        released = asyncio.ensure_future(self._in_thread(self._release_cursor, *opening.result()))
+        released.add_done_callback(lambda _: self._slots.release())
+
+    def _release_cursor(self, con: psycopg2.extensions.connection, cur) -> None:
+        try:
+            if cur is not None and not con.closed:
+                cur.close()
         finally:
-            await self._asyncify(cur.close)
-
-    async def get_messages(self) -> tuple[list[ModelMessage], list[ModelMessage]]:
-        messages = await self._get_messages()
-        return messages
-
-
-    def _execute(
-            self, sql: LiteralString, *args: Any, commit: bool = False
-    ) -> psycopg2.extensions.cursor:
-        cur = self.con.cursor()
-        cur.execute(sql, args)
-        if commit:
-            self.con.commit()
-        return cur
-
-    async def _asyncify(
-            self, func: Callable[P, R], *args: P.args, **kwargs: P.kwargs
-    ) -> R:
-        return await self._loop.run_in_executor(  # type: ignore
-            self._executor,
-            partial(func, *args, **kwargs),
-        )
+            self._checkin(con)
+
+    @staticmethod
+    def _fetch_turns(cur, count: int) -> list[CachedTurn]:
+        return _group_turns(cur.fetchmany(count))
+
+    @staticmethod
+    def _get_turns(
+            con: psycopg2.extensions.connection, conversation_id: str,
+            last_turns: int | None, since_ordinal: int
+    ) -> list[CachedTurn]:
+        with con.cursor() as cur:
+            # pick the window of turns first (index scan on turns(conversation_id, ordinal)),
+            # then only join the messages of those turns
+            cur.execute(
+                TURNS_WINDOW_SQL.format(direction='>'), (conversation_id, since_ordinal, last_turns)
+            )
+            return _group_turns(cur.fetchall())
+
+    ## Summaries of older turns
+
+    async def get_summary(self, conversation_id: str = DEFAULT_CONVERSATION) -> Summary | None:
+        """The newest summary of the conversation, ``None`` if it was never compacted."""
+        return await self._run(self._get_summary, conversation_id)
+
+    @staticmethod
+    def _get_summary(con: psycopg2.extensions.connection, conversation_id: str) -> Summary | None:
+        with con.cursor() as cur:
+            cur.execute("""
+            SELECT turns.id, turns.covers_ordinal, messages.message_list, turns.version
+            FROM turns JOIN messages ON messages.turn_id = turns.id
+            WHERE turns.conversation_id = %s AND turns.kind = 'summary'
+            ORDER BY turns.ordinal DESC
+            LIMIT 1;
+            """, (conversation_id,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        blob = decode_messages(bytes(row[2]), row[3])
+        return Summary(str(row[0]), row[1], ModelMessagesTypeAdapter.validate_json(blob))
+
+    async def add_summary(
+            self, conversation_id: str, covers_ordinal: int, messages: list[ModelMessage]
+    ) -> Summary:
+        """Store a summary of the turns up to ``covers_ordinal``, replacing the older ones."""
+        summary = Summary(str(uuid.uuid4()), covers_ordinal, messages)
+        await self._run(self._add_summary, conversation_id, summary, ModelMessagesTypeAdapter.dump_json(messages))
+        return summary
+
+    @staticmethod
+    def _add_summary(
+            con: psycopg2.extensions.connection, conversation_id: str, summary: Summary, message_list: bytes
+    ) -> None:
+        version = current_version()
+        blob = encode_messages(message_list, version)[0]
+        try:
+            with con.cursor() as cur:
+                # the new summary includes what the old ones said
+                cur.execute("""
+                DELETE FROM messages USING turns
+                WHERE messages.turn_id = turns.id AND turns.conversation_id = %s AND turns.kind = 'summary';
+                DELETE FROM turns WHERE conversation_id = %s AND kind = 'summary';
+                """, (conversation_id, conversation_id))
+                cur.execute(
+                    'INSERT INTO turns (id, conversation_id, version, kind, covers_ordinal) '
+                    "VALUES (%s, %s, %s, 'summary', %s);",
+                    (summary.turn_id, conversation_id, version, summary.covers_ordinal),
+                )
+                cur.execute(
+                    'INSERT INTO messages (turn_id, message_list) VALUES (%s, %s);',
+                    (summary.turn_id, psycopg2.Binary(blob)),
+                )
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            raise e
+
+    ## Upload jobs and document changes, shared by the worker processes
+
+    async def save_upload_job(self, job: dict[str, Any], documents_changed: bool = False) -> None:
+        """Store the state of an upload job, with ``documents_changed`` every worker is told to clear its caches."""
+        await self._run(self._save_upload_job, job, documents_changed)
+
+    @staticmethod
+    def _save_upload_job(con: psycopg2.extensions.connection, job: dict[str, Any], documents_changed: bool) -> None:
+        try:
+            with con.cursor() as cur:
+                cur.execute("""
+                INSERT INTO upload_jobs (id, job) VALUES (%s, %s)
+                ON CONFLICT (id) DO UPDATE SET job = EXCLUDED.job, updated_at = NOW();
+                """, (job['id'], json.dumps(job)))
+                if documents_changed:
+                    # delivered to the listeners when the transaction commits
+                    cur.execute('SELECT pg_notify(%s, %s);', (DOCUMENTS_CHANNEL, job['id']))
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            raise e
+
+    async def get_upload_job(self, job_id: str) -> dict[str, Any] | None:
+        return await self._run(self._get_upload_job, job_id)
+
+    @staticmethod
+    def _get_upload_job(con: psycopg2.extensions.connection, job_id: str) -> dict[str, Any] | None:
+        with con.cursor() as cur:
+            cur.execute('SELECT job FROM upload_jobs WHERE id = %s;', (job_id,))
+            row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    @asynccontextmanager
+    async def listen(self, channel: str, callback: Callable[[str], None]) -> AsyncIterator[None]:
+        """Call ``callback(payload)`` for every NOTIFY on ``channel`` while in the context.
+
+        Listens on a connection of its own, outside the pool. If it drops it is
+        opened again and ``callback('')`` is called for what may have been missed.
+        """
+        task = asyncio.create_task(self._listen(channel, callback), name=f'listen-{channel}')
+        try:
+            yield
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _listen(self, channel: str, callback: Callable[[str], None]) -> None:
+        reconnect = False
+        while True:
+            con = None
+            try:
+                con = await self._in_thread(partial(psycopg2.connect, **self._connect_kwargs))
+                con.autocommit = True
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL('LISTEN {};').format(sql.Identifier(channel)))
+                if reconnect:
+                    callback('')
+                readable = asyncio.Event()
+                fd = con.fileno()  # a dropped connection has no fileno left to remove the reader by
+                self._loop.add_reader(fd, readable.set)
+                try:
+                    while True:
+                        await readable.wait()
+                        readable.clear()
+                        con.poll()
+                        while con.notifies:
+                            callback(con.notifies.pop(0).payload)
+                finally:
+                    self._loop.remove_reader(fd)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('listening on %s failed, retrying in %ss', channel, LISTEN_RETRY_INTERVAL)
+            finally:
+                if con is not None:
+                    con.close()
+            reconnect = True
+            await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+    ## Storage format migration
+
+    async def migrate_messages(self, batch_size: int = 200, pause: float = 0.1) -> int:
+        """Rewrite turns stored in an older format in the current one, returns how many.
+
+        Runs in small batches with a pause in between, so chat requests still
+        get connections while it runs. Safe to run from several workers at once.
+        """
+        migrated = 0
+        while True:
+            count = await self._run(self._migrate_batch, batch_size)
+            migrated += count
+            if count < batch_size:
+                return migrated
+            await asyncio.sleep(pause)
+
+    @staticmethod
+    def _migrate_batch(con: psycopg2.extensions.connection, batch_size: int) -> int:
+        version = current_version()
+        try:
+            with con.cursor() as cur:
+                # rows another worker is migrating are skipped, not waited on
+                cur.execute("""
+                SELECT id, version FROM turns
+                WHERE version IS DISTINCT FROM %s
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED;
+                """, (version, batch_size))
+                turns = dict(cur.fetchall())
+                if not turns:
+                    con.rollback()
+                    return 0
+                cur.execute(
+                    'SELECT id, turn_id, message_list FROM messages WHERE turn_id = ANY(%s::uuid[]);',
+                    (list(map(str, turns)),),
+                )
+                rows = [
+                    (message_id, psycopg2.Binary(encode_messages(decode_messages(bytes(blob), turns[turn_id]), version)[0]))
+                    for message_id, turn_id, blob in cur.fetchall()
+                ]
+                if rows:
+                    execute_values(
+                        cur,
+                        'UPDATE messages SET message_list = data.blob FROM (VALUES %s) AS data (id, blob) '
+                        'WHERE messages.id = data.id::uuid;',
+                        rows,
+                    )
+                cur.execute('UPDATE turns SET version = %s WHERE id = ANY(%s::uuid[]);', (version, list(map(str, turns))))
+            con.commit()
+            return len(turns)
+        except Exception as e:
+            con.rollback()
+            raise e
@@ -0,0 +1,110 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      What every document search backend has to provide
+#      See vector_db.py for weaviate and local_index.py for the in-process index
+
+
+from __future__ import annotations as _annotations
+
+import hashlib
+import uuid
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Protocol
+
+import numpy as np
+
+# chunk object ids are uuid5s in this namespace, so storing a chunk twice overwrites it
+CHUNK_NAMESPACE = uuid.UUID('5b0c6f3e-8d1a-4f57-9a0e-2c4d7e1b9f60')
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def chunk_object_id(source_id: str, chunk_index: int) -> str:
+    return str(uuid.uuid5(CHUNK_NAMESPACE, f'{source_id}/{chunk_index}'))
+
+
+def file_hash(path: str | Path, block_size: int = 1 << 20) -> str:
+    """sha256 of a file, read in blocks. Used as the source id of an uploaded document."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class ChunkRecord:
+    """One chunk of an uploaded document as it is stored."""
+
+    content: str
+    source_id: str
+    filename: str
+    page: int
+    chunk_index: int
+    upload_date: str
+    content_hash: str = ''
+
+    @property
+    def object_id(self) -> str:
+        return chunk_object_id(self.source_id, self.chunk_index)
+
+    def properties(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class SearchHit:
+    """A stored chunk found by a search, ``score`` is higher for better matches."""
+
+    properties: dict[str, Any]
+    score: float = 0.0
+
+
+class VectorBackend(Protocol):
+    """Storage and similarity search of document chunks."""
+
+    # True if the backend needs the chunk and query vectors computed for it
+    needs_vectors: bool
+
+    def add_chunks(self, chunks: Iterable[tuple[ChunkRecord, np.ndarray | None]]) -> int:
+        """Store (chunk, vector) pairs, consuming them lazily. Returns how many were stored.
+
+        Storing a chunk with the ``object_id`` of one already stored does not add a second copy.
+        """
+        ...
+
+    def has_source(self, source_id: str) -> bool:
+        """True if chunks of the document ``source_id`` are stored."""
+        ...
+
+    def stored_vectors(self, content_hashes: list[str]) -> dict[str, np.ndarray]:
+        """Vectors already stored for chunks with these content hashes, so they are not embedded again."""
+        ...
+
+    def delete_source(self, source_id: str) -> int:
+        """Remove the chunks of the document ``source_id``. Returns how many."""
+        ...
+
+    def search(self, text: str, limit: int, query_vector: np.ndarray | None = None) -> list[SearchHit]:
+        """The ``limit`` chunks most similar to the query, best first."""
+        ...
+
+    def keyword_search(self, text: str, limit: int) -> list[SearchHit]:
+        """The ``limit`` best BM25 keyword matches for the query, best first."""
+        ...
+
+    def is_ready(self) -> bool:
+        """True if the store is answering requests."""
+        ...
+
+    def close(self) -> None:
+        ...
@@ -0,0 +1,71 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Local text embeddings with sentence-transformers
+#      Used instead of the OpenAI vectorizer when EMBEDDING_MODE=local
+
+
+from __future__ import annotations as _annotations
+
+import os
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
+from itertools import islice
+from threading import Lock
+from typing import TypeVar
+
+import numpy as np
+
+# remote: weaviate embeds with text2vec-openai, local: we embed with sentence-transformers
+EMBEDDING_MODE = os.getenv('EMBEDDING_MODE', 'remote')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '64'))
+
+T = TypeVar('T')
+
+_model = None
+_model_lock = Lock()
+
+
+def local_embeddings() -> bool:
+    return EMBEDDING_MODE == 'local'
+
+
+def get_model():
+    """The sentence-transformers model, loaded once on first use."""
+    global _model
+    with _model_lock:
+        if _model is None:
+            # imported here, it pulls in torch which is slow and only needed in local mode
+            from sentence_transformers import SentenceTransformer
+            _model = SentenceTransformer(EMBEDDING_MODEL, device='cpu')
+        return _model
+
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+    """Unit length embeddings of the texts, one row each, encoded in batches."""
+    return get_model().encode(
+        texts, batch_size=EMBEDDING_BATCH_SIZE, normalize_embeddings=True,
+        convert_to_numpy=True, show_progress_bar=False,
+    )
+
+
+@lru_cache(maxsize=1024)
+def _embed_query(text: str) -> np.ndarray:
+    vector = embed_texts([text])[0]
+    vector.setflags(write=False)  # shared between callers through the cache
+    return vector
+
+
+def embed_query(text: str) -> np.ndarray:
+    return _embed_query(text)
+
+
+def batched(items: Iterable[T], size: int = EMBEDDING_BATCH_SIZE) -> Iterator[list[T]]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
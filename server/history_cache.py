@@ -0,0 +1,244 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      In-process LRU cache of decoded chat history per conversation
+#      Saves re-reading and re-validating the stored message blobs every turn
+
+
+from __future__ import annotations as _annotations
+
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from pydantic_ai.messages import ModelMessage
+
+
+@dataclass
+class CachedTurn:
+    """One decoded turn of a conversation."""
+
+    turn_id: str
+    ordinal: int | None  # None while the turn is still queued for the database
+    messages: list[ModelMessage]
+    nbytes: int  # size of the stored blob, used as the memory estimate
+
+
+@dataclass
+class _Entry:
+    turns: list[CachedTurn]
+    # the entry holds every turn with an ordinal greater than this (0 means the whole conversation)
+    covers_after: int
+    loaded_at: float
+    nbytes: int = 0
+
+    @property
+    def pending(self) -> list[CachedTurn]:
+        return [t for t in self.turns if t.ordinal is None]
+
+
+def select_turns(
+        turns: list[CachedTurn], last_turns: int | None, since_ordinal: int
+) -> list[CachedTurn]:
+    """Apply a history window to turns sorted oldest first."""
+    selected = [t for t in turns if t.ordinal is None or t.ordinal > since_ordinal]
+    if last_turns is not None:
+        selected = selected[-last_turns:] if last_turns > 0 else []
+    return selected
+
+
+@dataclass
+class HistoryCache:
+    """LRU cache of decoded history keyed by conversation id.
+
+    Capped both by number of conversations and by the total stored blob size.
+    Entries expire after ``ttl`` seconds.
+
+    Turns queued for the database but not yet stored are held with no ordinal.
+    Entries holding such turns are never evicted or expired, the cache is the
+    only place they can be read from until the write completes.
+
+    With ``check_newest`` set (other processes write the same conversations)
+    `Database.get_turns` compares a hit with the newest ordinal in the
+    database and reloads the conversation if another process added turns.
+    """
+
+    max_conversations: int = 1000
+    max_bytes: int = 64 * 1024 * 1024
+    ttl: float = 300.0
+    check_newest: bool = False
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    stale: int = 0
+    nbytes: int = 0
+    _entries: OrderedDict[str, _Entry] = field(default_factory=OrderedDict)
+
+    def get(
+            self, conversation_id: str, last_turns: int | None = None, since_ordinal: int = 0
+    ) -> list[CachedTurn] | None:
+        """Get the window of turns, or ``None`` if the cache cannot answer it."""
+        entry = self._entries.get(conversation_id)
+        if entry is not None and time.monotonic() - entry.loaded_at > self.ttl and not entry.pending:
+            self._remove(conversation_id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        selected = select_turns(entry.turns, last_turns, since_ordinal)
+        enough = since_ordinal >= entry.covers_after or (
+                last_turns is not None and len(selected) >= last_turns
+        )
+        if not enough:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(conversation_id)
+        return selected
+
+    def put(self, conversation_id: str, turns: list[CachedTurn], covers_after: int) -> list[CachedTurn]:
+        """Store turns loaded from the database (sorted oldest first).
+
+        Returns the turns the conversation now has in the cache, the loaded
+        ones plus those still queued for the database.
+        """
+        existing = self._entries.get(conversation_id)
+        if existing is not None and existing.covers_after <= covers_after:
+            # what we already hold is at least as complete, just refresh it
+            existing.loaded_at = time.monotonic()
+            self._entries.move_to_end(conversation_id)
+            return list(existing.turns)
+        turns = list(turns)
+        if existing is not None:
+            # keep queued turns the load could not have seen yet
+            loaded = {t.turn_id for t in turns}
+            turns.extend(t for t in existing.pending if t.turn_id not in loaded)
+            self._remove(conversation_id)
+
+        entry = _Entry(turns, covers_after, time.monotonic())
+        entry.nbytes = sum(t.nbytes for t in turns)
+        self._entries[conversation_id] = entry
+        self.nbytes += entry.nbytes
+        self._shrink()
+        return list(turns)
+
+    def append(self, conversation_id: str, turn: CachedTurn) -> None:
+        """Write-through of a new turn.
+
+        A stored turn is only added if the conversation is cached. A queued turn
+        (no ordinal yet) is always added, it has nowhere else to be read from.
+        """
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            if turn.ordinal is not None:
+                return
+            # nothing else of this conversation is known, any window read still misses
+            entry = self._entries[conversation_id] = _Entry([], sys.maxsize, time.monotonic())
+        # concurrent writes can commit out of order, keep the list sorted by ordinal
+        # with queued turns last
+        index = len(entry.turns)
+        if turn.ordinal is not None:
+            while index > 0 and (
+                    entry.turns[index - 1].ordinal is None or entry.turns[index - 1].ordinal > turn.ordinal
+            ):
+                index -= 1
+        entry.turns.insert(index, turn)
+        entry.nbytes += turn.nbytes
+        self.nbytes += turn.nbytes
+        self._entries.move_to_end(conversation_id)
+        self._shrink()
+
+    def mark_stored(self, conversation_id: str, turn_id: str, ordinal: int) -> None:
+        """Record the ordinal of a queued turn once the database has it."""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        for turn in entry.turns:
+            if turn.turn_id == turn_id:
+                turn.ordinal = ordinal
+                break
+        # queued turns are written in order, but a direct write may have landed in between
+        entry.turns.sort(key=lambda t: sys.maxsize if t.ordinal is None else t.ordinal)
+        self._shrink()
+
+    def invalidate(self, conversation_id: str) -> None:
+        self._remove(conversation_id)
+
+    def discard(self, conversation_id: str, turn_ids: set[str]) -> None:
+        """Remove turns that will never be stored, e.g. a batch that failed to write.
+
+        The other turns of the conversation stay, including ones still queued.
+        """
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        dropped = sum(t.nbytes for t in entry.turns if t.turn_id in turn_ids)
+        entry.turns = [t for t in entry.turns if t.turn_id not in turn_ids]
+        entry.nbytes -= dropped
+        self.nbytes -= dropped
+
+    def newest_stored(self, conversation_id: str) -> int | None:
+        """Ordinal of the newest turn cached from the database, ``None`` if the conversation is not cached."""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return None
+        return max((t.ordinal for t in entry.turns if t.ordinal is not None), default=entry.covers_after)
+
+    def drop_stored(self, conversation_id: str) -> None:
+        """Forget the stored turns of a conversation another process has written to, queued turns stay."""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        self.stale += 1
+        pending = entry.pending
+        self._remove(conversation_id)
+        if pending:
+            # like a conversation only known from append, any window read misses until it is loaded
+            entry = self._entries[conversation_id] = _Entry(pending, sys.maxsize, time.monotonic())
+            entry.nbytes = sum(t.nbytes for t in pending)
+            self.nbytes += entry.nbytes
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            'conversations': len(self._entries),
+            'bytes': self.nbytes,
+            'pending_turns': sum(len(e.pending) for e in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale': self.stale,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, conversation_id: str) -> None:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def _shrink(self) -> None:
+        while len(self._entries) > self.max_conversations or self.nbytes > self.max_bytes:
+            # least recently used first, skipping conversations with queued turns
+            victim = next(
+                ((cid, e) for cid, e in self._entries.items() if not e.pending), None
+            )
+            if victim is None:
+                return
+            conversation_id, entry = victim
+            if len(self._entries) == 1 and len(entry.turns) > 1:
+                # a single huge conversation, drop its oldest turns instead of all of it
+                oldest = entry.turns.pop(0)
+                entry.nbytes -= oldest.nbytes
+                self.nbytes -= oldest.nbytes
+                entry.covers_after = oldest.ordinal
+                continue
+            self._remove(conversation_id)
+            self.evictions += 1
@@ -0,0 +1,86 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      The shared http client used by the agent tools and the
+#      retrying GET they call the geocoding and weather APIs with
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import email.utils
+import os
+import time
+from typing import Any
+
+import httpx
+
+# one pooled client for the whole process, connections are kept alive between chats
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+
+# retries of rate limited (429), unavailable (502/503/504) and failed requests
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+# a Retry-After longer than this is not waited for, the tool fails instead
+HTTP_MAX_RETRY_WAIT = float(os.getenv('HTTP_MAX_RETRY_WAIT', '5'))
+
+RETRY_STATUS = {429, 502, 503, 504}
+
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+    )
+
+
+def retry_after(response: httpx.Response) -> float | None:
+    """Seconds the server asked us to wait, the header is either seconds or a date."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+async def get_json(
+        client: httpx.AsyncClient, url: str, params: dict[str, Any], retries: int = HTTP_RETRIES
+) -> Any:
+    """GET ``url`` and return the json body, retrying rate limits and transient failures.
+
+    Waits the server's Retry-After when it sends one, otherwise backs off
+    exponentially. Raises ``httpx.HTTPStatusError`` or ``httpx.TransportError``
+    when out of retries or when the server wants a longer wait than
+    ``HTTP_MAX_RETRY_WAIT``.
+    """
+    for attempt in range(retries + 1):
+        backoff = HTTP_RETRY_BACKOFF * 2 ** attempt
+        try:
+            response = await client.get(url, params=params)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+            delay = backoff
+        else:
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                response.raise_for_status()
+                return response.json()
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff
+            elif delay > HTTP_MAX_RETRY_WAIT:
+                response.raise_for_status()
+        await asyncio.sleep(delay)
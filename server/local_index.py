@@ -0,0 +1,301 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      In-process document index, used instead of weaviate when VECTOR_BACKEND=local
+#      Vectors live in a memory-mapped file searched with numpy
+
+
+from __future__ import annotations as _annotations
+
+import json
+import math
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from threading import RLock
+
+import numpy as np
+
+from bm25 import BM25Index
+from document_store import ChunkRecord, SearchHit, chunk_object_id
+from embeddings import batched, embed_query
+
+VECTORS_FILE = 'vectors.f32'
+META_FILE = 'meta.jsonl'
+HEADER_FILE = 'index.json'
+ANN_FILE = 'ivf.npz'
+
+
+@dataclass
+class IvfIndex:
+    """Inverted file index: rows grouped by their nearest of a few centroids.
+
+    A search only scores the rows of the ``probe`` clusters closest to the
+    query instead of every row. Rows added after the index was built
+    (``covered`` and up) are searched exhaustively until it is rebuilt.
+    """
+
+    centroids: np.ndarray  # (clusters, dim), unit length
+    rows: np.ndarray  # row numbers ordered by cluster
+    offsets: np.ndarray  # rows of cluster c are rows[offsets[c]:offsets[c + 1]]
+    covered: int
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, iterations: int = 8, seed: int = 0) -> IvfIndex:
+        count = len(vectors)
+        clusters = max(1, int(math.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(vectors[rng.choice(count, clusters, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assignment = cls._assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            for start in range(0, count, 65536):
+                np.add.at(sums, assignment[start:start + 65536], vectors[start:start + 65536])
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # clusters that lost all their rows keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        assignment = cls._assign(vectors, centroids)
+        rows = np.argsort(assignment, kind='stable')
+        offsets = np.searchsorted(assignment[rows], np.arange(clusters + 1))
+        return cls(centroids, rows, offsets, count)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # in blocks so a big memory map is never copied into memory at once
+        return np.concatenate([
+            np.argmax(np.asarray(vectors[start:start + 65536]) @ centroids.T, axis=1)
+            for start in range(0, len(vectors), 65536)
+        ])
+
+    def candidates(self, query_vector: np.ndarray, probe: int) -> np.ndarray:
+        nearest = np.argsort(self.centroids @ query_vector)[::-1][:probe]
+        return np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in nearest])
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix('.tmp.npz')
+        np.savez(tmp, centroids=self.centroids, rows=self.rows, offsets=self.offsets, covered=self.covered)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> IvfIndex:
+        with np.load(path) as data:
+            return cls(data['centroids'], data['rows'], data['offsets'], int(data['covered']))
+
+
+class LocalBackend:
+    """Document chunks stored in a directory, searched by cosine similarity.
+
+    ``vectors.f32`` holds the unit length chunk vectors one row after another,
+    ``meta.jsonl`` the matching chunk properties one line each and
+    ``index.json`` how many rows (and metadata bytes) are complete, anything
+    past that is left over from an interrupted write and is overwritten.
+    Deleted rows are listed in ``index.json`` and skipped by searches, the
+    files are only ever appended to.
+    Only one process may use a directory, the row count is kept in memory
+    and the locks are in-process (serve.py refuses it with several workers).
+    Nothing is read until the first search or ingest. With ``ann_min_rows`` set, an `IvfIndex` is built once
+    the index has that many rows and rebuilt when a fifth of them are new.
+    """
+
+    needs_vectors = True
+
+    def __init__(self, directory: Path, ann_min_rows: int = 0, ann_probe: int = 8):
+        self.directory = Path(directory)
+        self.ann_min_rows = ann_min_rows
+        self.ann_probe = ann_probe
+        self._lock = RLock()
+        self._write_lock = RLock()
+        self._loaded = False
+        self._meta_bytes = 0
+        self._dim: int | None = None
+        self._count = 0
+        self._vectors: np.ndarray | None = None
+        self._meta: list[dict] = []
+        self._ivf: IvfIndex | None = None
+        self._bm25: BM25Index | None = None
+        self._deleted: set[int] = set()
+        self._deleted_rows = np.empty(0, dtype=np.int64)
+        self._rows_by_id: dict[str, int] = {}
+        self._rows_by_hash: dict[str, int] = {}
+        self._source_rows: dict[str, int] = {}  # source id -> live rows
+
+    def add_chunks(self, chunks: Iterable[tuple[ChunkRecord, np.ndarray | None]]) -> int:
+        added = 0
+        # one writer at a time, searches keep running on the rows already stored
+        with self._write_lock:
+            with self._lock:
+                self._load()
+            with open(self.directory / VECTORS_FILE, 'r+b' if self._count else 'wb') as vectors_file, \
+                    open(self.directory / META_FILE, 'r+b' if self._count else 'wb') as meta_file:
+                # drop anything past the last complete write, e.g. after a crash
+                vectors_file.truncate(self._count * (self._dim or 0) * 4)
+                meta_file.truncate(self._meta_bytes)
+                vectors_file.seek(0, os.SEEK_END)
+                meta_file.seek(0, os.SEEK_END)
+                # chunks already stored (and not deleted) are skipped
+                chunks = (pair for pair in chunks if not self._is_stored(pair[0].object_id))
+                for group in batched(chunks, 256):
+                    matrix = np.stack([vector for _, vector in group]).astype(np.float32)
+                    if self._dim is not None and matrix.shape[1] != self._dim:
+                        raise ValueError(f'vectors have {matrix.shape[1]} dimensions, the index has {self._dim}')
+                    lines = b''.join(json.dumps(chunk.properties()).encode('utf-8') + b'\n' for chunk, _ in group)
+                    vectors_file.write(matrix.tobytes())
+                    meta_file.write(lines)
+                    vectors_file.flush()
+                    meta_file.flush()
+                    with self._lock:
+                        self._dim = matrix.shape[1]
+                        for chunk, _ in group:
+                            self._meta.append(chunk.properties())
+                            self._track(len(self._meta) - 1, self._meta[-1])
+                        if self._bm25 is not None:
+                            for chunk, _ in group:
+                                self._bm25.add(chunk.content)
+                        self._meta_bytes += len(lines)
+                        self._count += len(group)
+                        self._write_header()
+                        self._map_vectors()
+                    added += len(group)
+            self._maybe_build_ann()
+        return added
+
+    def search(self, text: str, limit: int, query_vector: np.ndarray | None = None) -> list[SearchHit]:
+        if query_vector is None:
+            query_vector = embed_query(text)
+        with self._lock:
+            self._load()
+            # a consistent snapshot, adds only map new arrays and append past count
+            vectors, meta, count, ivf = self._vectors, self._meta, self._count, self._ivf
+            deleted = self._deleted_rows
+        if not count or vectors is None:
+            return []
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if ivf is not None:
+            candidates = np.concatenate([
+                ivf.candidates(query_vector, self.ann_probe), np.arange(ivf.covered, count)
+            ])
+            scores = np.asarray(vectors[candidates]) @ query_vector
+        else:
+            candidates = None
+            scores = np.asarray(vectors[:count]) @ query_vector
+        if len(deleted):
+            scores[np.isin(candidates if candidates is not None else np.arange(count), deleted)] = -np.inf
+
+        k = min(limit, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        rows = candidates[top] if candidates is not None else top
+        return [SearchHit(dict(meta[row]), float(scores[i])) for row, i in zip(rows, top)]
+
+    def keyword_search(self, text: str, limit: int) -> list[SearchHit]:
+        with self._lock:
+            self._load()
+            if self._bm25 is None:
+                # built from the stored metadata the first time it is needed
+                self._bm25 = BM25Index()
+                for props in self._meta:
+                    self._bm25.add(props['content'])
+            bm25, meta, deleted = self._bm25, self._meta, self._deleted_rows
+        return [SearchHit(dict(meta[row]), score) for row, score in bm25.search(text, limit, deleted)]
+
+    def has_source(self, source_id: str) -> bool:
+        with self._lock:
+            self._load()
+            return self._source_rows.get(source_id, 0) > 0
+
+    def stored_vectors(self, content_hashes: list[str]) -> dict[str, np.ndarray]:
+        with self._lock:
+            self._load()
+            # rows are never overwritten, so even the vector of a deleted row is still valid
+            rows = {h: self._rows_by_hash[h] for h in content_hashes if h in self._rows_by_hash}
+            vectors = self._vectors
+        if not rows or vectors is None:
+            return {}
+        return {h: np.array(vectors[row]) for h, row in rows.items()}
+
+    def delete_source(self, source_id: str) -> int:
+        with self._write_lock, self._lock:
+            self._load()
+            rows = [
+                row for row, props in enumerate(self._meta)
+                if props['source_id'] == source_id and row not in self._deleted
+            ]
+            if not rows:
+                return 0
+            self._source_rows[source_id] = 0
+            self._deleted.update(rows)
+            self._deleted_rows = np.fromiter(sorted(self._deleted), dtype=np.int64)
+            self._write_header()
+            return len(rows)
+
+    def is_ready(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._vectors = None
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        header_path = self.directory / HEADER_FILE
+        if header_path.exists():
+            header = json.loads(header_path.read_text())
+            self._dim, self._count, self._meta_bytes = header['dim'], header['count'], header['meta_bytes']
+            self._deleted = set(header.get('deleted', []))
+            self._deleted_rows = np.fromiter(sorted(self._deleted), dtype=np.int64)
+            with open(self.directory / META_FILE, 'rb') as meta_file:
+                self._meta = [json.loads(line) for _, line in zip(range(self._count), meta_file)]
+            for row, props in enumerate(self._meta):
+                self._track(row, props)
+            self._map_vectors()
+            ann_path = self.directory / ANN_FILE
+            if ann_path.exists():
+                ivf = IvfIndex.load(ann_path)
+                self._ivf = ivf if ivf.covered <= self._count else None
+        self._loaded = True
+
+    def _track(self, row: int, props: dict) -> None:
+        self._rows_by_id[chunk_object_id(props['source_id'], props['chunk_index'])] = row
+        if props.get('content_hash'):
+            self._rows_by_hash[props['content_hash']] = row
+        if row not in self._deleted:
+            self._source_rows[props['source_id']] = self._source_rows.get(props['source_id'], 0) + 1
+
+    def _is_stored(self, object_id: str) -> bool:
+        row = self._rows_by_id.get(object_id)
+        return row is not None and row not in self._deleted
+
+    def _map_vectors(self) -> None:
+        if self._count and self._dim:
+            self._vectors = np.memmap(
+                self.directory / VECTORS_FILE, dtype=np.float32, mode='r', shape=(self._count, self._dim)
+            )
+
+    def _write_header(self) -> None:
+        tmp = self.directory / (HEADER_FILE + '.tmp')
+        tmp.write_text(json.dumps({
+            'dim': self._dim, 'count': self._count, 'meta_bytes': self._meta_bytes,
+            'deleted': sorted(self._deleted),
+        }))
+        os.replace(tmp, self.directory / HEADER_FILE)
+
+    def _maybe_build_ann(self) -> None:
+        if not self.ann_min_rows or self._count < self.ann_min_rows or self._vectors is None:
+            return
+        if self._ivf is not None and self._count - self._ivf.covered < self._ivf.covered // 5:
+            return
+        ivf = IvfIndex.build(self._vectors)
+        ivf.save(self.directory / ANN_FILE)
+        with self._lock:
+            self._ivf = ivf
@@ -0,0 +1,72 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Storage formats of the message_list blobs, told apart by turns.version
+#      New turns are stored compressed, old rows are rewritten in the background
+
+
+from __future__ import annotations as _annotations
+
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, zlib is always there
+    zstandard = None
+
+# plain pydantic-ai messages json, how every turn was stored at first
+JSON_VERSION = '0.0.1'
+# the same json compressed with zlib
+ZLIB_VERSION = '0.1.0'
+# the same json compressed with zstandard, smaller and faster to decode than zlib
+ZSTD_VERSION = '0.2.0'
+
+CODECS = {'json': JSON_VERSION, 'zlib': ZLIB_VERSION, 'zstd': ZSTD_VERSION}
+
+# format new turns are written in, zstd when the zstandard package is installed
+MESSAGE_CODEC = os.getenv('MESSAGE_CODEC', 'zstd' if zstandard is not None else 'zlib')
+ZSTD_LEVEL = int(os.getenv('MESSAGE_ZSTD_LEVEL', '3'))
+ZLIB_LEVEL = int(os.getenv('MESSAGE_ZLIB_LEVEL', '6'))
+
+
+class UnknownMessageFormat(Exception):
+    """Raised for a blob whose version this server can not decode."""
+
+
+def current_version() -> str:
+    if MESSAGE_CODEC not in CODECS:
+        raise ValueError(f'MESSAGE_CODEC must be one of {", ".join(CODECS)}, not {MESSAGE_CODEC!r}')
+    if CODECS[MESSAGE_CODEC] == ZSTD_VERSION and zstandard is None:
+        raise ValueError('MESSAGE_CODEC=zstd needs the zstandard package')
+    return CODECS[MESSAGE_CODEC]
+
+
+def encode_messages(messages_json: bytes, version: str | None = None) -> tuple[bytes, str]:
+    """The blob to store for ``messages_json`` and the version to store with it."""
+    version = version or current_version()
+    if version == JSON_VERSION:
+        return messages_json, version
+    if version == ZLIB_VERSION:
+        return zlib.compress(messages_json, ZLIB_LEVEL), version
+    if version == ZSTD_VERSION:
+        # compressor objects are not thread safe, and cheap to make
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(messages_json), version
+    raise UnknownMessageFormat(version)
+
+
+def decode_messages(blob: bytes, version: str | None) -> bytes:
+    """The messages json stored in ``blob``. A missing version is the original plain json."""
+    if version is None or version == JSON_VERSION:
+        return blob
+    if version == ZLIB_VERSION:
+        return zlib.decompress(blob)
+    if version == ZSTD_VERSION:
+        if zstandard is None:
+            raise UnknownMessageFormat(f'{version} (zstd) rows need the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    raise UnknownMessageFormat(version)
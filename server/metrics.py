@@ -0,0 +1,172 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Counters, gauges and histograms of the server, rendered in the
+#      prometheus text format on GET /metrics, no collector needed
+#      Each worker process keeps its own numbers
+
+
+from __future__ import annotations as _annotations
+
+import bisect
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable
+
+import logfire
+
+# seconds, from a fast cache hit to a slow llm answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: tuple[tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name, self.help, self.kind = name, help, 'counter'
+        self._values: dict[Labels, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}_total{_format_labels(labels)} {_format_value(value)}'
+
+
+class Gauge:
+    """A value read from ``callback`` when the metrics are rendered."""
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        self.name, self.help, self.kind = name, help, 'gauge'
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return  # whatever it reads is gone, e.g. after shutdown
+        yield f'{self.name} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name, self.help, self.kind = name, help, 'histogram'
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count per bucket, sum, count)
+        self._values: dict[Labels, tuple[list[int], float, int]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_format_labels(labels, (("le", _format_value(bound)),))} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {count}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> Gauge:
+        """Register (or replace, e.g. when the app restarts) a gauge read from ``callback``."""
+        gauge = Gauge(name, help, callback)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: list[str] = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('chat_stage_seconds', 'Time spent in each stage of a chat or upload request')
+history_messages = registry.histogram(
+    'chat_history_messages', 'Messages of history sent to the llm per turn', (0, 5, 10, 20, 50, 100, 200, 500),
+)
+history_bytes = registry.histogram(
+    'chat_history_bytes', 'Bytes of stored history sent to the llm per turn',
+    (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6),
+)
+history_tokens = registry.histogram(
+    'chat_history_tokens', 'Estimated tokens of history sent to the llm per turn',
+    (100, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+llm_tokens = registry.counter('llm_tokens', 'Tokens used by the llm, by kind (request, response, summary_request or summary_response)')
+llm_requests = registry.counter('llm_requests', 'Requests made to the llm')
+
+
+@contextmanager
+def stage(name: str, **attributes) -> Iterator[None]:
+    """Time one stage of the hot path, as a logfire span and in ``chat_stage_seconds``."""
+    with logfire.span('stage {stage}', stage=name, **attributes), stage_seconds.time(stage=name):
+        yield
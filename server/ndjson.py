@@ -0,0 +1,36 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Encodes the json lines the chat endpoints stream to the browser
+#      Uses orjson when it is installed and the json module otherwise
+
+
+from __future__ import annotations as _annotations
+
+import json
+import os
+from typing import Any, Iterable
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the output is the same json either way
+    orjson = None
+
+# json forces the json module even with orjson installed, e.g. to compare them
+NDJSON_ENCODER = os.getenv('NDJSON_ENCODER', 'orjson' if orjson is not None else 'json')
+_use_orjson = NDJSON_ENCODER == 'orjson' and orjson is not None
+
+
+def ndjson_line(obj: Any) -> bytes:
+    """One json object and its newline, as utf-8."""
+    if _use_orjson:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(obj).encode('utf-8') + b'\n'
+
+
+def ndjson_lines(objs: Iterable[Any]) -> bytes:
+    return b''.join(ndjson_line(obj) for obj in objs)
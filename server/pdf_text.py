@@ -0,0 +1,120 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Extracts the text of PDF documents page by page
+#      Large documents can be split across worker processes
+
+
+from __future__ import annotations as _annotations
+
+import multiprocessing
+import os
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Union
+
+import fitz  # PyMuPDF
+
+# worker processes used to parse big documents, 1 parses everything in the calling thread
+PARSE_PROCESSES = int(os.getenv('PDF_PARSE_PROCESSES', '1'))
+# pages each worker process parses at a time
+SHARD_PAGES = int(os.getenv('PDF_SHARD_PAGES', '32'))
+
+PdfSource = Union[str, Path, bytes]
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = Lock()
+
+
+def _open(source: PdfSource) -> fitz.Document:
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def page_count(source: PdfSource) -> int:
+    with _open(source) as pdf_document:
+        return pdf_document.page_count
+
+
+def iter_pdf_pages(
+        source: PdfSource, start: int = 0, stop: int | None = None
+) -> Iterator[tuple[int, str]]:
+    """Yield (page number, text) for pages ``start`` to ``stop`` as each one is parsed.
+
+    Page numbers start at 1, ``start`` and ``stop`` are zero based like ``range``.
+    """
+    with _open(source) as pdf_document:
+        stop = pdf_document.page_count if stop is None else min(stop, pdf_document.page_count)
+        for page_num in range(start, stop):
+            yield page_num + 1, pdf_document.load_page(page_num).get_text()
+
+
+def extract_pages_from_pdf(
+        source: PdfSource, on_page: Callable[[int, int], None] | None = None,
+        processes: int = PARSE_PROCESSES,
+) -> Iterator[tuple[int, str]]:
+    """Yield (page number, text) of every page in order, as soon as each is available.
+
+    Documents given as a file path with more than ``SHARD_PAGES`` pages are
+    parsed in shards on ``processes`` worker processes. ``on_page(pages_parsed,
+    pages_total)`` is called as each page is yielded.
+    """
+    total = page_count(source)
+    if processes > 1 and not isinstance(source, (bytes, bytearray)) and total > SHARD_PAGES:
+        pages = _iter_sharded(str(source), total, processes)
+    else:
+        pages = iter_pdf_pages(source)
+
+    for parsed, page in enumerate(pages, 1):
+        if on_page is not None:
+            on_page(parsed, total)
+        yield page
+
+
+def extract_text_from_pdf(source: PdfSource) -> str:
+    return "".join(text for _, text in iter_pdf_pages(source))
+
+
+def _extract_range(path: str, start: int, stop: int) -> list[tuple[int, str]]:
+    return list(iter_pdf_pages(path, start, stop))
+
+
+def _iter_sharded(path: str, total: int, processes: int) -> Iterator[tuple[int, str]]:
+    pool = _get_pool(processes)
+    futures = [
+        pool.submit(_extract_range, path, start, min(start + SHARD_PAGES, total))
+        for start in range(0, total, SHARD_PAGES)
+    ]
+    try:
+        # shards finish in any order but pages are yielded in document order
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _get_pool(processes: int) -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking a server process that is running threads is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
@@ -0,0 +1,171 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Background writer that saves chat turns to postgres in batches
+#      so the chat response does not wait for the database
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+import logfire
+from pydantic_ai.messages import ModelMessage
+
+from database import Database, NewTurn
+from history_cache import CachedTurn
+from metrics import stage_seconds
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TurnWriter:
+    """Queue of turns waiting to be written, flushed by one background task.
+
+    A batch is written when ``max_batch`` turns are waiting or ``flush_interval``
+    seconds after its first turn arrived, whichever comes first. The queue is
+    bounded, when it is full `submit` waits, which is the backpressure.
+    Queued turns are put in the history cache straight away so the next turn of
+    the conversation sees them before they reach the database.
+    """
+
+    database: Database
+    max_batch: int = 100
+    flush_interval: float = 0.05
+    max_queue: int = 10000
+    max_retries: int = 3
+
+    _queue: asyncio.Queue[NewTurn] = field(init=False)
+    _task: asyncio.Task[None] | None = field(default=None, init=False)
+
+    # counters, see stats()
+    submitted: int = 0
+    written: int = 0
+    failed: int = 0
+    batches: int = 0
+    blocked: int = 0
+    blocked_seconds: float = 0.0
+    max_depth: int = 0
+    last_batch_size: int = 0
+    last_flush_seconds: float = 0.0
+
+    def __post_init__(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+
+    @classmethod
+    @asynccontextmanager
+    async def start(cls, database: Database, **kwargs) -> AsyncIterator[TurnWriter]:
+        """Run the writer for the duration of the context, draining the queue on exit."""
+        slf = cls(database, **kwargs)
+        slf._task = asyncio.create_task(slf._run(), name='turn-writer')
+        try:
+            yield slf
+        finally:
+            await slf.close()
+
+    async def submit(
+            self, turn_id: str, conversation_id: str, message_list: bytes, decoded: list[ModelMessage]
+    ) -> None:
+        """Queue one turn for writing."""
+        if self.database.history_cache is not None:
+            self.database.history_cache.append(
+                conversation_id, CachedTurn(turn_id, None, decoded, len(message_list))
+            )
+        turn = NewTurn(turn_id, conversation_id, message_list)
+        try:
+            self._queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            self.blocked += 1
+            started = time.perf_counter()
+            await self._queue.put(turn)
+            self.blocked_seconds += time.perf_counter() - started
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    async def close(self) -> None:
+        """Write everything still queued and stop the background task."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self.max_depth,
+            'queue_capacity': self.max_queue,
+            'submitted': self.submitted,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+            'blocked_submits': self.blocked,
+            'blocked_seconds': self.blocked_seconds,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_seconds': self.last_flush_seconds,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: list[NewTurn]) -> None:
+        started = time.perf_counter()
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with logfire.span('write turns', batch_size=len(batch)), stage_seconds.time(stage='db_write'):
+                    ordinals = await self.database.add_turns(batch)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    logger.exception('dropping %d chat turns after %d attempts', len(batch), attempt)
+                    if self.database.history_cache is not None:
+                        # the lost turns must not linger in the cache as if they were stored,
+                        # turns of the same conversations queued in later batches stay
+                        lost: dict[str, set[str]] = {}
+                        for turn in batch:
+                            lost.setdefault(turn.conversation_id, set()).add(turn.turn_id)
+                        for conversation_id, turn_ids in lost.items():
+                            self.database.history_cache.discard(conversation_id, turn_ids)
+                    return
+                logger.warning('writing %d chat turns failed, retrying', len(batch), exc_info=True)
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+        self.batches += 1
+        self.written += len(batch)
+        self.last_batch_size = len(batch)
+        self.last_flush_seconds = time.perf_counter() - started
+        if self.database.history_cache is not None:
+            for turn in batch:
+                self.database.history_cache.mark_stored(
+                    turn.conversation_id, turn.turn_id, ordinals[turn.turn_id]
+                )
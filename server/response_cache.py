@@ -0,0 +1,143 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Answers chat prompts without the llm when we already know the answer:
+#      fixed intents like help and about, and exact repeats of earlier questions
+
+
+from __future__ import annotations as _annotations
+
+import hashlib
+import json
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any
+
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+from caching import TTLCache
+from retrieval_cache import normalize_query
+
+# prompts (after normalize_query) answered by a tool that always returns the same text
+INTENTS: dict[str, set[str]] = {
+    'help': {'help', 'what can you do', 'what can you do for me'},
+    'about': {'about', 'who are you', 'what are you'},
+    'mark': {
+        'the mark this project will get', 'what mark will this project get',
+        'what mark will the project get', 'what is the mark this project will get',
+    },
+}
+
+# llm round trips a tool intent costs: one to call the tool, one to repeat its text
+INTENT_LLM_CALLS = 2
+
+
+def match_intent(prompt: str) -> str | None:
+    """The intent the prompt asks for, only exact phrasings so nothing else is caught."""
+    normalized = normalize_query(prompt)
+    for intent, phrases in INTENTS.items():
+        if normalized in phrases:
+            return intent
+    return None
+
+
+def history_text(messages: list[ModelMessage]) -> list[tuple[str, str]]:
+    """(kind, content) of what the llm sees of the history, without timestamps or ids."""
+    text: list[tuple[str, str]] = []
+    for message in messages:
+        for part in message.parts:
+            if isinstance(part, SystemPromptPart):
+                text.append(('system', part.content))
+            elif isinstance(part, UserPromptPart):
+                text.append(('user', part.content))
+            elif isinstance(part, TextPart):
+                text.append(('model', part.content))
+            elif isinstance(part, ToolCallPart):
+                text.append(('tool-call', f'{part.tool_name} {part.args_as_json_str()}'))
+            elif isinstance(part, ToolReturnPart):
+                text.append(('tool-return', part.model_response_str()))
+    return text
+
+
+def used_tools(messages: list[ModelMessage]) -> bool:
+    return any(
+        isinstance(part, ToolCallPart)
+        for message in messages if isinstance(message, ModelResponse)
+        for part in message.parts
+    )
+
+
+@dataclass
+class CachedResponse:
+    text: str
+    tokens: int  # tokens the llm call that produced it used
+
+
+class ResponseCache:
+    """Final answers keyed by (normalized prompt, history window, model).
+
+    Only answers that did not call a tool are stored, weather and document
+    answers depend on more than the prompt. Counts the llm calls and tokens
+    saved by cache hits and by the intent fast path.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, history_turns: int = 20):
+        self.history_turns = history_turns
+        self.intent_hits = 0
+        self.llm_calls_saved = 0
+        self.tokens_saved = 0
+        self._cache: TTLCache[str, CachedResponse] = TTLCache(max_entries, ttl)
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache.max_entries > 0
+
+    def key(self, prompt: str, history: list[list[ModelMessage]], model: str) -> str:
+        """``history`` is the turns sent with the prompt, only the last ``history_turns`` count."""
+        window = history[-self.history_turns:] if self.history_turns else []
+        messages = [message for turn in window for message in turn]
+        material = json.dumps([normalize_query(prompt), history_text(messages), model])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> CachedResponse | None:
+        if not self.enabled:
+            return None
+        cached = self._cache.get(key)
+        if cached is not None:
+            with self._lock:
+                self.llm_calls_saved += 1
+                self.tokens_saved += cached.tokens
+        return cached
+
+    def put(self, key: str, text: str, tokens: int, new_messages: list[ModelMessage]) -> None:
+        if self.enabled and not used_tools(new_messages):
+            self._cache.set(key, CachedResponse(text, tokens))
+
+    def record_intent(self, tokens: int) -> None:
+        """An intent was answered locally, ``tokens`` is an estimate of what the llm would have used."""
+        with self._lock:
+            self.intent_hits += 1
+            self.llm_calls_saved += INTENT_LLM_CALLS
+            self.tokens_saved += tokens
+
+    def stats(self) -> dict[str, Any]:
+        cache = self._cache.stats()
+        return {
+            **cache,
+            'intent_hits': self.intent_hits,
+            'llm_calls_saved': self.llm_calls_saved,
+            'tokens_saved': self.tokens_saved,
+        }
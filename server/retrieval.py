@@ -0,0 +1,85 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Combines keyword and vector search results, optionally re-ranks them
+#      and packs the best passages into the prompt budget of the retrieve tool
+
+
+from __future__ import annotations as _annotations
+
+import os
+from threading import Lock
+
+from document_store import SearchHit
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+# cross-encoder used to re-rank fused results, empty to skip re-ranking
+RERANK_MODEL = os.getenv('RERANK_MODEL', '')
+
+_reranker = None
+_reranker_lock = Lock()
+
+
+def hit_key(hit: SearchHit) -> tuple:
+    """Identity of a chunk across the result lists of different searches."""
+    props = hit.properties
+    return props.get('source_id'), props.get('chunk_index'), props.get('content')
+
+
+def reciprocal_rank_fusion(result_lists: list[list[SearchHit]], k: int = 60) -> list[SearchHit]:
+    """Merge ranked lists, each chunk scores the sum of 1 / (k + rank) over the lists it is in."""
+    fused: dict[tuple, SearchHit] = {}
+    for hits in result_lists:
+        for rank, hit in enumerate(hits, 1):
+            key = hit_key(hit)
+            if key not in fused:
+                fused[key] = SearchHit(hit.properties, 0.0)
+            fused[key].score += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda h: h.score, reverse=True)
+
+
+def rerank(query: str, hits: list[SearchHit]) -> list[SearchHit]:
+    """Order hits by the cross-encoder score of (query, passage), if one is configured."""
+    if not RERANK_MODEL or len(hits) < 2:
+        return hits
+    scores = get_reranker().predict([(query, hit.properties['content']) for hit in hits])
+    return [
+        SearchHit(hit.properties, float(score))
+        for hit, score in sorted(zip(hits, scores), key=lambda pair: pair[1], reverse=True)
+    ]
+
+
+def get_reranker():
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            # imported here, it pulls in torch which is slow and only needed when re-ranking
+            from sentence_transformers import CrossEncoder
+            _reranker = CrossEncoder(RERANK_MODEL, device='cpu')
+        return _reranker
+
+
+def pack_context(hits: list[SearchHit], token_budget: int) -> str:
+    """Best passages first, each labelled with its source, until the budget is used.
+
+    A passage that does not fit is cut to what is left if that is still a
+    useful amount, otherwise packing stops.
+    """
+    passages: list[str] = []
+    remaining = token_budget
+    for hit in hits:
+        props = hit.properties
+        label = f"[{props.get('filename') or 'document'}, page {props.get('page', '?')}]"
+        passage = f"{label}\n{props['content']}"
+        cost = estimate_tokens(passage)
+        if cost > remaining:
+            if remaining >= 50:
+                passages.append(passage[:remaining * CHARS_PER_TOKEN] + '...')
+            break
+        passages.append(passage)
+        remaining -= cost
+    return '\n\n'.join(passages)
@@ -0,0 +1,122 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Cache of document search results so repeated questions
+#      skip the vector database and the embedding service
+
+
+from __future__ import annotations as _annotations
+
+import re
+from threading import Lock
+from typing import Any, Callable
+
+import numpy as np
+
+from caching import TTLCache
+
+WORD = re.compile(r'\w+')
+
+
+def normalize_query(text: str) -> str:
+    """Lower case words only, so punctuation and spacing do not change the key."""
+    return ' '.join(WORD.findall(text.lower()))
+
+
+class RetrievalCache:
+    """Search results keyed by normalized query text and result limit.
+
+    When ``embed`` is given, a query that misses the exact key is embedded and
+    compared to the cached queries, results of one with a cosine similarity of
+    at least ``similarity_threshold`` are reused. Everything cached is dropped
+    by `invalidate`, which is called whenever documents are added.
+    """
+
+    def __init__(
+            self, max_entries: int = 1024, ttl: float = 600.0,
+            similarity_threshold: float = 0.95,
+            embed: Callable[[str], np.ndarray] | None = None,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        # values are (results, unit query vector or None)
+        self._cache: TTLCache[tuple[str, int], tuple[Any, np.ndarray | None]] = TTLCache(max_entries, ttl)
+        self._lock = Lock()
+        self.generation = 0
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, query: str, limit: int) -> Any | None:
+        """Results cached under exactly this query, cheap enough for the event loop."""
+        hit = self._cache.get((normalize_query(query), limit))
+        if hit is None:
+            return None
+        self.exact_hits += 1
+        return hit[0]
+
+    def query_vector(self, query: str) -> np.ndarray | None:
+        """Unit embedding of the query for the similarity tier, ``None`` when it is off."""
+        return self._unit(self.embed(query)) if self.embed is not None else None
+
+    def get_similar(self, query_vector: np.ndarray | None, limit: int) -> Any | None:
+        """Results of the most similar cached query above the threshold."""
+        if query_vector is None:
+            return None
+        candidates = [
+            (key, vector) for key, (_, vector) in self._cache.items()
+            if key[1] == limit and vector is not None
+        ]
+        if not candidates:
+            return None
+        similarities = np.stack([vector for _, vector in candidates]) @ query_vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        hit = self._cache.get(candidates[best][0])  # also marks it as recently used
+        if hit is None:
+            return None
+        self.similar_hits += 1
+        return hit[0]
+
+    def put(
+            self, query: str, limit: int, results: Any, generation: int,
+            query_vector: np.ndarray | None = None,
+    ) -> None:
+        """Cache the results of a search that started when ``generation`` was current."""
+        with self._lock:
+            self.misses += 1
+            # documents were added while the search ran, its results may be stale
+            if generation != self.generation:
+                return
+            self._cache.set((normalize_query(query), limit), (results, query_vector))
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._cache.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            'entries': len(self._cache),
+            'exact_hits': self.exact_hits,
+            'similar_hits': self.similar_hits,
+            'misses': self.misses,
+            'hit_rate': (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            'evictions': self._cache.evictions,
+            'expirations': self._cache.expirations,
+            'invalidations': self.invalidations,
+        }
+
+    @staticmethod
+    def _unit(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,78 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Production launch of the chat server: several worker processes, each
+#      with its own event loop, database pool, http client and document store
+#      connection (all made in chat_server.lifespan), on uvloop and httptools
+#      when they are installed. For development use python server/chat_server.py
+#
+#      python server/serve.py
+
+
+from __future__ import annotations as _annotations
+
+import importlib.util
+import logging
+import os
+from pathlib import Path
+
+import uvicorn
+from dotenv import load_dotenv
+
+SERVER_DIR = Path(__file__).parent
+
+load_dotenv()
+
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '8000'))
+# one per cpu by default, every worker has its own pool of DB_POOL_MAX_SIZE connections
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', str(os.cpu_count() or 1)))
+# seconds a stopping worker waits for open streams, the turn writer drains after that
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+WEB_KEEP_ALIVE = int(os.getenv('WEB_KEEP_ALIVE', '5'))
+# addresses of proxies allowed to set X-Forwarded-For, the client ip the rate limit uses
+WEB_FORWARDED_ALLOW_IPS = os.getenv('WEB_FORWARDED_ALLOW_IPS', '127.0.0.1')
+# read here only to refuse the local index with several workers, see main
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'weaviate')
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if VECTOR_BACKEND == 'local' and WEB_WORKERS > 1:
+        # the local index keeps its row count in memory and locks in-process only,
+        # workers appending to the same files would cut off each other's chunks
+        raise SystemExit('VECTOR_BACKEND=local only works with WEB_WORKERS=1, use weaviate for more workers')
+    # the workers read it too, e.g. to check their history cache against the database
+    os.environ['WEB_WORKERS'] = str(WEB_WORKERS)
+    # uvloop is not available on windows, the asyncio loop and h11 always are
+    loop = 'uvloop' if installed('uvloop') else 'asyncio'
+    http = 'httptools' if installed('httptools') else 'h11'
+    if loop != 'uvloop' or http != 'httptools':
+        logging.warning('running on %s and %s, install uvloop and httptools for the faster ones', loop, http)
+    uvicorn.run(
+        'chat_server:app',
+        app_dir=str(SERVER_DIR),
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=WEB_WORKERS,
+        loop=loop,
+        http=http,
+        lifespan='on',
+        proxy_headers=True,
+        forwarded_allow_ips=WEB_FORWARDED_ALLOW_IPS,
+        timeout_keep_alive=WEB_KEEP_ALIVE,
+        timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+        access_log=False,  # the metrics and traces cover requests, a log line each is slow
+    )
+
+
+if __name__ == '__main__':
+    main()
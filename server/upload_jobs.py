@@ -0,0 +1,160 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Runs document uploads as background jobs on a worker pool
+#      so parsing and ingesting a PDF never blocks the chat
+
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Literal
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyUploads(Exception):
+    """Raised when the upload queue is full."""
+
+
+@dataclass
+class UploadJob:
+    """Progress of one uploaded document, updated by the worker thread."""
+
+    id: str
+    filename: str
+    status: Literal['queued', 'parsing', 'embedding', 'done', 'failed'] = 'queued'
+    pages_total: int = 0
+    pages_parsed: int = 0
+    chunks_embedded: int = 0
+    source_id: str | None = None
+    duplicate: bool = False
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class UploadJobs:
+    """Worker pool for upload jobs plus the status of recent jobs.
+
+    At most ``max_workers`` jobs run at once, at most ``max_pending`` may be
+    queued or running before new uploads are refused, and the status of the
+    last ``keep_finished`` finished jobs is kept for polling.
+
+    ``publish(job)`` is awaited when a job is queued, every
+    ``publish_interval`` seconds while it runs and when it finishes, so
+    other worker processes can answer for the job (see chat_server).
+    """
+
+    max_workers: int = 2
+    max_pending: int = 20
+    keep_finished: int = 1000
+    publish: Callable[[UploadJob], Awaitable[None]] | None = None
+    publish_interval: float = 1.0
+
+    _executor: ThreadPoolExecutor = field(init=False)
+    _jobs: OrderedDict[str, UploadJob] = field(default_factory=OrderedDict, init=False)
+    _tasks: set[asyncio.Task[None]] = field(default_factory=set, init=False)
+
+    def __post_init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='upload')
+
+    @classmethod
+    @asynccontextmanager
+    async def start(cls, **kwargs) -> AsyncIterator[UploadJobs]:
+        """Run the pool for the duration of the context, letting running jobs finish on exit."""
+        slf = cls(**kwargs)
+        try:
+            yield slf
+        finally:
+            if slf._tasks:
+                await asyncio.gather(*slf._tasks, return_exceptions=True)
+            slf._executor.shutdown(wait=True)
+
+    @property
+    def pending(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def submit(self, filename: str, work: Callable[[UploadJob], str]) -> UploadJob:
+        """Queue ``work(job)`` on the pool, it returns the source id of the ingested document."""
+        if self.pending >= self.max_pending:
+            raise TooManyUploads(f'{self.pending} uploads are already being processed')
+
+        job = UploadJob(id=str(uuid.uuid4()), filename=filename)
+        self._jobs[job.id] = job
+        self._forget_old()
+
+        task = asyncio.create_task(self._run(job, work), name=f'upload-{job.id}')
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str) -> UploadJob | None:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'workers': self.max_workers,
+            'jobs': len(self._jobs),
+        }
+
+    async def _run(self, job: UploadJob, work: Callable[[UploadJob], str]) -> None:
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+        progress = asyncio.create_task(self._publish_progress(job, finished)) if self.publish is not None else None
+        try:
+            job.source_id = await loop.run_in_executor(self._executor, work, job)
+            job.status = 'done'
+        except Exception as e:
+            logger.exception('upload %s (%s) failed', job.id, job.filename)
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            if progress is not None:
+                # not cancelled, a write cut off here could still land after the last one
+                finished.set()
+                await progress
+                await self._publish(job)
+
+    async def _publish_progress(self, job: UploadJob, finished: asyncio.Event) -> None:
+        while not finished.is_set():
+            await self._publish(job)
+            try:
+                await asyncio.wait_for(finished.wait(), timeout=self.publish_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _publish(self, job: UploadJob) -> None:
+        try:
+            await self.publish(job)
+        except Exception:
+            # the job goes on, only other workers polling for it see old progress
+            logger.exception('publishing upload %s failed', job.id)
+
+    def _forget_old(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
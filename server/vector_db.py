@@ -5,66 +5,398 @@
 #  School: Port Credit Secondary School
 #  Teacher: Mrs. Kim
 #  Description: 
-#      Handles the weaviate vector database connection and queries
+#      Handles the document store (weaviate or the local index) and queries
 #      Used for handling the document questions
 
+import asyncio
 import os
-import fitz  # PyMuPDF
+import time
+import numpy as np
 import weaviate
 from weaviate.classes.config import Configure, Property, DataType, Tokenization
+from weaviate.classes.init import AdditionalConfig, Timeout
+from weaviate.classes.query import Filter, MetadataQuery
+from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Iterable
+from uuid import uuid4
 
 
-# Initialize the client
-headers = {
-    "X-OpenAI-Api-Key": os.getenv("OPENAI_API_KEY")
-} 
-weaviate_client = weaviate.connect_to_local(headers=headers)
-
-doc_collection = weaviate_client.collections.get("Document")
-if doc_collection is None:
-    # Create a new collection
-    weaviate_client.collections.create(
-                        "Document",
-                        # vectorizer_config=Configure.Vectorizer.text2vec_transformers(),
-                        vectorizer_config = Configure.Vectorizer.text2vec_openai(vectorize_collection_name=True),
-                        properties= [  # properties configuration is optional
-                            # Property(name="title", data_type=DataType.TEXT),
-                            # Property(name="summary", data_type=DataType.TEXT),
-                            Property(name="content", data_type=DataType.TEXT, vectorize_property_name=True,tokenization=Tokenization.LOWERCASE),
-                            Property(name="upload_date", data_type=DataType.DATE),
-                            ]
-                        )
-
-
-
-def extract_text_from_pdf(pdf_bytes: bytes) -> str:
-    # Open the PDF from bytes
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    text = ""
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document.load_page(page_num)
-        text += page.get_text()
-    return text
-
-def ingest_text_to_weaviate(content: str) -> None:
-    # Create a new document
-    document = {
-        "content": content,
-        "upload_date": datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-    }
-    uuid = weaviate_client.collections.get("Document").data.insert(document)
-    print(f"Document with UUID {uuid} has been created")
-
-def search_documents(text: str) -> dict:
-    # Search for similar documents
-
-    collection = weaviate_client.collections.get("Document")
-    search_results = collection.query.near_text(
-        query=text,
-        limit=2
-    )
-
-    docs = search_results.objects
+from chunking import chunk_pages
+from retrieval_cache import RetrievalCache
+from embeddings import batched, embed_query, embed_texts, local_embeddings
+from document_store import ChunkRecord, SearchHit, VectorBackend, content_hash
+from local_index import LocalBackend
+from metrics import stage_seconds
+from retrieval import RERANK_MODEL, reciprocal_rank_fusion, rerank
 
+# chunking and batching of uploaded documents
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '1000'))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', '200'))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '100'))
+
+# where chunks are stored and searched: weaviate, or local for the in-process index
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'weaviate')
+LOCAL_INDEX_DIR = Path(os.getenv('LOCAL_INDEX_DIR', Path(__file__).parent.parent / 'data' / 'local_index'))
+LOCAL_INDEX_ANN_MIN_ROWS = int(os.getenv('LOCAL_INDEX_ANN_MIN_ROWS', '0'))
+LOCAL_INDEX_ANN_PROBE = int(os.getenv('LOCAL_INDEX_ANN_PROBE', '16'))
+# seconds before connecting is tried again after the document store could not be reached
+BACKEND_RETRY_INTERVAL = float(os.getenv('VECTOR_BACKEND_RETRY_INTERVAL', '30'))
+
+# searches run on their own threads so a slow vector db never blocks the event loop
+RETRIEVE_WORKERS = int(os.getenv('RETRIEVE_WORKERS', '4'))
+RETRIEVE_TIMEOUT = float(os.getenv('RETRIEVE_TIMEOUT', '5'))
+# hybrid search: vector and keyword candidates fused by reciprocal rank
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', '1') == '1'
+RETRIEVE_CANDIDATES = int(os.getenv('RETRIEVE_CANDIDATES', '20'))
+RRF_K = int(os.getenv('RRF_K', '60'))
+search_executor = ThreadPoolExecutor(max_workers=RETRIEVE_WORKERS, thread_name_prefix='retrieve')
+_searches_submitted = 0  # on search_executor, running or waiting for a thread
+
+# repeated questions reuse earlier search results until new documents arrive
+retrieval_cache = RetrievalCache(
+    max_entries=int(os.getenv('RETRIEVAL_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('RETRIEVAL_CACHE_TTL', '600')),
+    similarity_threshold=float(os.getenv('RETRIEVAL_CACHE_SIMILARITY', '0.95')),
+    # queries are embedded in-process anyway with local vectors, so the similarity tier is free
+    embed=embed_query if local_embeddings() or VECTOR_BACKEND == 'local' else None,
+)
+
+# properties of a chunk that only describe where it came from, they are not embedded
+SOURCE_PROPERTIES = [
+    Property(name="source_id", data_type=DataType.TEXT, skip_vectorization=True, tokenization=Tokenization.FIELD),
+    Property(name="filename", data_type=DataType.TEXT, skip_vectorization=True),
+    Property(name="page", data_type=DataType.INT, skip_vectorization=True),
+    Property(name="chunk_index", data_type=DataType.INT, skip_vectorization=True),
+    Property(name="content_hash", data_type=DataType.TEXT, skip_vectorization=True, tokenization=Tokenization.FIELD),
+]
+
+class WeaviateBackend:
+    """Chunks stored in the weaviate ``Document`` (or ``DocumentLocal``) collection."""
+
+    def __init__(self):
+        # Initialize the client
+        headers = {
+            "X-OpenAI-Api-Key": os.getenv("OPENAI_API_KEY")
+        } 
+        self.client = weaviate.connect_to_local(
+            headers=headers,
+            # give up on queries the caller has stopped waiting for so the search threads free up
+            additional_config=AdditionalConfig(timeout=Timeout(query=RETRIEVE_TIMEOUT)),
+        )
+        self.needs_vectors = local_embeddings()
+        # local embeddings live in their own collection, their vectors do not mix with openai ones
+        self.collection_name = "DocumentLocal" if self.needs_vectors else "Document"
+        self._create_collection()
+
+    def _create_collection(self) -> None:
+        if not self.client.collections.exists(self.collection_name):
+            # Create a new collection
+            self.client.collections.create(
+                                self.collection_name,
+                                # vectorizer_config=Configure.Vectorizer.text2vec_transformers(),
+                                vectorizer_config = (
+                                    # we send the vectors ourselves
+                                    Configure.Vectorizer.none() if self.needs_vectors
+                                    else Configure.Vectorizer.text2vec_openai(vectorize_collection_name=True)
+                                ),
+                                properties= [  # properties configuration is optional
+                                    # Property(name="title", data_type=DataType.TEXT),
+                                    # Property(name="summary", data_type=DataType.TEXT),
+                                    Property(name="content", data_type=DataType.TEXT, vectorize_property_name=True,tokenization=Tokenization.LOWERCASE),
+                                    Property(name="upload_date", data_type=DataType.DATE),
+                                    *SOURCE_PROPERTIES,
+                                    ]
+                                )
+        else:
+            # collections created before chunking only have content and upload_date
+            doc_collection = self.client.collections.get(self.collection_name)
+            existing = {p.name for p in doc_collection.config.get().properties}
+            for prop in SOURCE_PROPERTIES:
+                if prop.name not in existing:
+                    doc_collection.config.add_property(prop)
+
+    def add_chunks(self, chunks: Iterable[tuple[ChunkRecord, np.ndarray | None]]) -> int:
+        collection = self.client.collections.get(self.collection_name)
+        count = 0
+        with collection.batch.fixed_size(batch_size=INGEST_BATCH_SIZE) as batch:
+            for chunk, vector in chunks:
+                batch.add_object(
+                    properties=chunk.properties(),
+                    # the same chunk stored again replaces itself instead of adding a duplicate
+                    uuid=chunk.object_id,
+                    vector=vector.tolist() if vector is not None else None,
+                )
+                count += 1
+
+        failed = collection.batch.failed_objects
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {count} chunks failed to insert: {failed[0].message}")
+        return count
+
+    def search(self, text: str, limit: int, query_vector: np.ndarray | None = None) -> list[SearchHit]:
+        collection = self.client.collections.get(self.collection_name)
+        if self.needs_vectors:
+            if query_vector is None:
+                query_vector = embed_query(text)
+            search_results = collection.query.near_vector(
+                near_vector=query_vector.tolist(),
+                limit=limit,
+                return_metadata=MetadataQuery(distance=True),
+            )
+        else:
+            search_results = collection.query.near_text(
+                query=text,
+                limit=limit,
+                return_metadata=MetadataQuery(distance=True),
+            )
+        return [
+            SearchHit(dict(obj.properties), 1.0 - (obj.metadata.distance or 0.0))
+            for obj in search_results.objects
+        ]
+
+    def keyword_search(self, text: str, limit: int) -> list[SearchHit]:
+        collection = self.client.collections.get(self.collection_name)
+        search_results = collection.query.bm25(
+            query=text,
+            query_properties=["content"],
+            limit=limit,
+            return_metadata=MetadataQuery(score=True),
+        )
+        return [SearchHit(dict(obj.properties), obj.metadata.score or 0.0) for obj in search_results.objects]
+
+    def has_source(self, source_id: str) -> bool:
+        collection = self.client.collections.get(self.collection_name)
+        found = collection.query.fetch_objects(
+            filters=Filter.by_property("source_id").equal(source_id), limit=1, return_properties=[],
+        )
+        return bool(found.objects)
+
+    def stored_vectors(self, content_hashes: list[str]) -> dict[str, np.ndarray]:
+        if not content_hashes:
+            return {}
+        collection = self.client.collections.get(self.collection_name)
+        found = collection.query.fetch_objects(
+            filters=Filter.by_property("content_hash").contains_any(content_hashes),
+            # a few extra, the same text can be stored for several documents
+            limit=len(content_hashes) * 2,
+            include_vector=True,
+            return_properties=["content_hash"],
+        )
+        return {
+            obj.properties["content_hash"]: np.asarray(obj.vector["default"], dtype=np.float32)
+            for obj in found.objects if obj.vector.get("default")
+        }
+
+    def delete_source(self, source_id: str) -> int:
+        collection = self.client.collections.get(self.collection_name)
+        result = collection.data.delete_many(where=Filter.by_property("source_id").equal(source_id))
+        return result.successful
+
+    def is_ready(self) -> bool:
+        return self.client.is_ready()
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def create_backend() -> VectorBackend:
+    if VECTOR_BACKEND == "local":
+        return LocalBackend(LOCAL_INDEX_DIR, ann_min_rows=LOCAL_INDEX_ANN_MIN_ROWS, ann_probe=LOCAL_INDEX_ANN_PROBE)
+    return WeaviateBackend()
+
+
+## The shared backend, connected on first use so the server starts without the document store
+
+class DocumentStoreUnavailable(Exception):
+    """Raised when the document store can not be reached."""
+
+_backend: VectorBackend | None = None
+_backend_lock = Lock()
+_backend_error: str | None = None
+_backend_failed_at = 0.0
+
+def get_backend() -> VectorBackend:
+    """The connected backend, connecting (and creating the collection) the first time.
+
+    After a failed connect, callers get `DocumentStoreUnavailable` straight
+    away for ``BACKEND_RETRY_INTERVAL`` seconds instead of each waiting on
+    their own connect timeout.
+    """
+    global _backend, _backend_error, _backend_failed_at
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            if _backend_error is not None and time.monotonic() - _backend_failed_at < BACKEND_RETRY_INTERVAL:
+                raise DocumentStoreUnavailable(_backend_error)
+            try:
+                _backend = create_backend()
+            except Exception as exc:
+                _backend_error, _backend_failed_at = f"{type(exc).__name__}: {exc}", time.monotonic()
+                raise DocumentStoreUnavailable(_backend_error) from exc
+            _backend_error = None
+        return _backend
+
+def connect_backend() -> bool:
+    """Try to connect now, used at startup. Returns whether it worked."""
+    try:
+        get_backend()
+        return True
+    except DocumentStoreUnavailable as exc:
+        print(f"Document store is not available, chat works without documents: {exc}")
+        return False
+
+def backend_status() -> dict[str, Any]:
+    """Whether the document store is connected and answering, for the readiness check."""
+    ready = False
+    if _backend is not None:
+        try:
+            ready = _backend.is_ready()
+        except Exception:
+            ready = False
+    return {"backend": VECTOR_BACKEND, "connected": _backend is not None, "ready": ready, "error": _backend_error}
+
+def close_backend() -> None:
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+
+def document_stored(source_id: str) -> bool:
+    return get_backend().has_source(source_id)
+
+def delete_document(source_id: str) -> int:
+    """Remove every chunk of a document, returns how many."""
+    try:
+        return get_backend().delete_source(source_id)
+    finally:
+        retrieval_cache.invalidate()
+
+def ingest_text_to_weaviate(
+        pages: Iterable[tuple[int, str]], filename: str = "",
+        on_chunk: Callable[[int], None] | None = None,
+        source_id: str | None = None,
+        replaces: str | None = None,
+) -> str:
+    """Chunk the pages of a document and store the chunks in the document backend.
+
+    The name is kept from when weaviate was the only backend.
+    ``pages`` is consumed lazily, so chunks of the first pages are already
+    being sent while later pages are still being parsed.
+
+    ``source_id`` should be a hash of the document (see `file_hash`). A
+    document that is already stored is skipped without reading ``pages``,
+    chunks whose text is already stored reuse their vector instead of being
+    embedded again. Without a ``source_id`` the document gets a random one.
+
+    ``replaces`` is the source id of an earlier version the uploader wants
+    gone, it is removed once the new one is stored. Documents are never
+    replaced by name, other people may have uploaded a file called the same.
+
+    ``on_chunk(chunks_added)`` is called after each chunk is handed to the backend.
+    Returns the source id shared by all chunks of the document.
+    """
+    backend = get_backend()
+    if source_id is None:
+        source_id = str(uuid4())
+    elif backend.has_source(source_id):
+        print(f"Document {source_id} is already stored")
+        if replaces and replaces != source_id:
+            delete_document(replaces)
+        return source_id
+    upload_date = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    reused = 0
+
+    def records():
+        nonlocal reused
+        count = 0
+        for chunks in batched(chunk_pages(pages, CHUNK_SIZE, CHUNK_OVERLAP)):
+            hashes = [content_hash(c.text) for c in chunks]
+            vectors = backend.stored_vectors(hashes)
+            reused += sum(h in vectors for h in hashes)
+            missing = list({h: c.text for h, c in zip(hashes, chunks) if h not in vectors}.items())
+            # when we embed, the new chunks of a group are embedded in one call
+            if missing and backend.needs_vectors:
+                with stage_seconds.time(stage='embed'):
+                    vectors.update(zip([h for h, _ in missing], embed_texts([text for _, text in missing])))
+            for chunk, chunk_hash in zip(chunks, hashes):
+                yield ChunkRecord(
+                    content=chunk.text, source_id=source_id, filename=filename,
+                    page=chunk.page, chunk_index=chunk.index, upload_date=upload_date,
+                    content_hash=chunk_hash,
+                ), vectors.get(chunk_hash)
+                count += 1
+                if on_chunk is not None:
+                    on_chunk(count)
+
+    try:
+        count = backend.add_chunks(records())
+        # only the version the uploader asked to replace goes
+        removed = backend.delete_source(replaces) if replaces and replaces != source_id else 0
+    finally:
+        # cached search results do not know about the new chunks
+        retrieval_cache.invalidate()
+
+    print(f"Document {source_id} has been stored as {count} chunks "
+          f"({reused} reused, {removed} old chunks removed)")
+    return source_id
+
+def search_documents(text: str, limit: int = 8, query_vector: np.ndarray | None = None) -> list[SearchHit]:
+    """Search for the chunks that best answer the query.
+
+    Vector and BM25 keyword candidates are merged by reciprocal rank fusion,
+    so exact terms (names, codes) are found even when the embedding misses
+    them, then optionally re-ranked by a cross-encoder.
+    """
+    backend = get_backend()
+    candidates = max(limit, RETRIEVE_CANDIDATES)
+    with stage_seconds.time(stage='vector_search'):
+        hits = backend.search(text, candidates, query_vector)
+    if HYBRID_SEARCH:
+        with stage_seconds.time(stage='keyword_search'):
+            keyword_hits = backend.keyword_search(text, candidates)
+        hits = reciprocal_rank_fusion([hits, keyword_hits], RRF_K)[:candidates]
+    if not RERANK_MODEL:
+        return hits[:limit]
+    with stage_seconds.time(stage='rerank'):
+        return rerank(text, hits)[:limit]
+
+def search_documents_cached(text: str, limit: int = 8) -> list[SearchHit]:
+    """`search_documents` behind the similarity tier of the retrieval cache."""
+    generation = retrieval_cache.generation
+    query_vector = retrieval_cache.query_vector(text)
+    docs = retrieval_cache.get_similar(query_vector, limit)
+    if docs is None:
+        docs = search_documents(text, limit, query_vector)
+        retrieval_cache.put(text, limit, docs, generation, query_vector)
     return docs
+
+async def search_documents_async(
+        text: str, limit: int = 8, timeout: float | None = RETRIEVE_TIMEOUT
+) -> list[SearchHit]:
+    """Cached `search_documents` on the search thread pool.
+
+    Exact repeats are answered from the cache without leaving the event loop.
+    Raises ``asyncio.TimeoutError`` if the search takes longer than ``timeout``
+    seconds and `DocumentStoreUnavailable` if the store can not be reached.
+    """
+    docs = retrieval_cache.get(text, limit)
+    if docs is not None:
+        return docs
+    global _searches_submitted
+    loop = asyncio.get_running_loop()
+    _searches_submitted += 1
+    try:
+        future = loop.run_in_executor(search_executor, search_documents_cached, text, limit)
+        return await asyncio.wait_for(future, timeout=timeout)
+    finally:
+        _searches_submitted -= 1
+
+def search_queue_depth() -> int:
+    """Searches waiting for a search thread, for the metrics."""
+    return max(0, _searches_submitted - RETRIEVE_WORKERS)
@@ -0,0 +1,16 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      The server modules import each other by name, like when chat_server.py runs
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'server'))
+# the tests never configure logfire, its spans are no-ops
+os.environ.setdefault('LOGFIRE_IGNORE_NO_CONFIG', '1')
@@ -0,0 +1,134 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Admission control and the per client rate limit
+
+import asyncio
+
+import pytest
+
+from admission import AdmissionControl, Overloaded, RateLimiter, parse_model_limits, retry_after_header
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_parse_model_limits():
+    assert parse_model_limits('openai:gpt-4o=8, openai:gpt-4o-mini=16,') == {
+        'openai:gpt-4o': 8, 'openai:gpt-4o-mini': 16,
+    }
+    assert parse_model_limits('') == {}
+
+
+def test_retry_after_header_rounds_up():
+    assert retry_after_header(0.2) == {'Retry-After': '1'}
+    assert retry_after_header(2.1) == {'Retry-After': '3'}
+
+
+def test_admits_up_to_the_limit_and_releases_once():
+    async def main():
+        control = AdmissionControl(max_concurrent=2, max_queue=0)
+        first = await control.acquire('m')
+        second = await control.acquire('m')
+        assert control.in_flight == 2
+        with pytest.raises(Overloaded):
+            await control.acquire('m')
+        first.release()
+        first.release()  # a second release does not free another slot
+        assert control.in_flight == 1
+        third = await control.acquire('m')
+        second.release()
+        third.release()
+        return control.stats()
+
+    stats = run(main())
+    assert stats['in_flight'] == 0
+    assert stats['admitted'] == 3
+    assert stats['rejected_queue_full'] == 1
+
+
+def test_waiting_chat_gets_the_released_slot():
+    async def main():
+        control = AdmissionControl(max_concurrent=1, max_queue=1, queue_timeout=5)
+        ticket = await control.acquire('m')
+        waiter = asyncio.create_task(control.acquire('m'))
+        await asyncio.sleep(0)
+        assert control.waiting == 1
+        ticket.release()
+        (await waiter).release()
+        return control.stats()
+
+    stats = run(main())
+    assert stats['queued'] == 1
+    assert stats['waiting'] == 0
+    assert stats['max_waiting'] == 1
+
+
+def test_queue_full_and_timeout():
+    async def main():
+        control = AdmissionControl(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        ticket = await control.acquire('m')
+        waiter = asyncio.create_task(control.acquire('m'))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as queue_full:
+            await control.acquire('m')
+        with pytest.raises(Overloaded):
+            await waiter
+        ticket.release()
+        return control, queue_full.value
+
+    control, error = run(main())
+    assert error.retry_after >= 1
+    assert control.rejected_queue_full == 1
+    assert control.rejected_timeout == 1
+    assert control.in_flight == 0
+
+
+def test_model_limits_are_separate():
+    async def main():
+        control = AdmissionControl(max_concurrent=4, model_limits={'small': 1}, max_queue=0)
+        small = await control.acquire('small')
+        with pytest.raises(Overloaded):
+            await control.acquire('small')
+        # another model still has room
+        other = await control.acquire('big')
+        small.release()
+        other.release()
+        async with control.slot('small'):
+            assert control.in_flight == 1
+        return control
+
+    assert run(main()).in_flight == 0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_burst_then_refill(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('admission.time.monotonic', clock)
+    limiter = RateLimiter(per_minute=60, burst=3)
+    assert [limiter.take('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('a') == pytest.approx(1.0)
+    # other clients have their own bucket
+    assert limiter.take('b') == 0
+    clock.now += 1.0
+    assert limiter.take('a') == 0
+    assert limiter.take('a') > 0
+    assert limiter.stats()['limited'] == 2
+
+
+def test_rate_limiter_off():
+    limiter = RateLimiter(per_minute=0)
+    assert not limiter.enabled
+    assert all(limiter.take('a') == 0 for _ in range(100))
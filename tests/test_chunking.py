@@ -0,0 +1,68 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Sentence chunking of document pages
+
+import pytest
+
+from chunking import chunk_pages, split_sentences
+
+
+def sentences(count, words=8):
+    return ' '.join(f'Sentence {i} ' + 'word ' * words + 'end.' for i in range(count))
+
+
+def test_split_sentences_on_punctuation_and_blank_lines():
+    text = 'One two.  Three?\nFour!\n\nFive   six'
+    assert split_sentences(text) == ['One two.', 'Three?', 'Four!', 'Five six']
+
+
+def test_short_page_is_one_chunk():
+    chunks = list(chunk_pages([(1, 'Hello there. How are you?')]))
+    assert [(c.text, c.page, c.index) for c in chunks] == [('Hello there. How are you?', 1, 0)]
+
+
+def test_chunks_respect_size_and_keep_whole_sentences():
+    text = sentences(40)
+    chunks = list(chunk_pages([(1, text)], chunk_size=200, overlap=50))
+    assert len(chunks) > 1
+    assert all(len(c.text) <= 200 for c in chunks)
+    assert all(c.text.startswith('Sentence') and c.text.endswith('end.') for c in chunks)
+    # every sentence of the page ends up in some chunk
+    for sentence in split_sentences(text):
+        assert any(sentence in c.text for c in chunks)
+
+
+def test_neighbouring_chunks_overlap():
+    chunks = list(chunk_pages([(1, sentences(40))], chunk_size=200, overlap=80))
+    for first, second in zip(chunks, chunks[1:]):
+        last_sentence = split_sentences(first.text)[-1]
+        assert second.text.startswith(last_sentence)
+
+
+def test_no_overlap():
+    chunks = list(chunk_pages([(1, sentences(40))], chunk_size=200, overlap=0))
+    joined = ' '.join(c.text for c in chunks)
+    assert joined == ' '.join(split_sentences(sentences(40)))
+
+
+def test_chunks_never_cross_pages_and_indexes_continue():
+    chunks = list(chunk_pages([(1, sentences(10)), (2, ''), (3, sentences(10))], chunk_size=150, overlap=30))
+    assert {c.page for c in chunks} == {1, 3}
+    assert [c.index for c in chunks] == list(range(len(chunks)))
+    first_of_page_3 = next(c for c in chunks if c.page == 3)
+    assert first_of_page_3.text.startswith('Sentence 0')
+
+
+def test_long_sentence_is_cut_to_chunk_size():
+    chunks = list(chunk_pages([(1, 'x' * 450)], chunk_size=100, overlap=20))
+    assert [len(c.text) for c in chunks] == [100, 100, 100, 100, 50]
+
+
+def test_overlap_must_be_smaller_than_chunk_size():
+    with pytest.raises(ValueError):
+        list(chunk_pages([(1, 'text')], chunk_size=100, overlap=100))
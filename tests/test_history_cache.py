@@ -0,0 +1,144 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      Windows, coverage and queued turns of the decoded history cache
+
+from history_cache import CachedTurn, HistoryCache, select_turns
+
+
+def turn(ordinal, turn_id=None, nbytes=10):
+    return CachedTurn(turn_id or f't{ordinal}', ordinal, [], nbytes)
+
+
+def ordinals(turns):
+    return [t.ordinal for t in turns]
+
+
+def test_select_turns_window():
+    turns = [turn(1), turn(2), turn(3), turn(None, 'queued')]
+    assert ordinals(select_turns(turns, None, 0)) == [1, 2, 3, None]
+    assert ordinals(select_turns(turns, 2, 0)) == [3, None]
+    assert ordinals(select_turns(turns, None, 2)) == [3, None]
+    assert select_turns(turns, 0, 0) == []
+
+
+def test_whole_conversation_answers_any_window():
+    cache = HistoryCache()
+    cache.put('c', [turn(1), turn(2), turn(3)], covers_after=0)
+    assert ordinals(cache.get('c', 2)) == [2, 3]
+    assert ordinals(cache.get('c', None, since_ordinal=1)) == [2, 3]
+    assert ordinals(cache.get('c', 20)) == [1, 2, 3]
+    assert cache.hits == 3
+
+
+def test_partial_entry_misses_wider_windows():
+    cache = HistoryCache()
+    # only the turns after ordinal 4 were loaded
+    cache.put('c', [turn(5), turn(6)], covers_after=4)
+    assert ordinals(cache.get('c', 2)) == [5, 6]
+    assert cache.get('c', 3) is None
+    assert cache.get('c', None) is None
+    assert ordinals(cache.get('c', None, since_ordinal=4)) == [5, 6]
+
+
+def test_unknown_conversation_misses():
+    cache = HistoryCache()
+    assert cache.get('nope', 5) is None
+    assert cache.misses == 1
+
+
+def test_queued_turn_is_served_and_marked_stored():
+    cache = HistoryCache()
+    cache.put('c', [turn(1)], covers_after=0)
+    cache.append('c', turn(None, 'new'))
+    assert [t.turn_id for t in cache.get('c', 5)] == ['t1', 'new']
+    cache.mark_stored('c', 'new', 2)
+    assert ordinals(cache.get('c', 5)) == [1, 2]
+
+
+def test_queued_turn_of_uncached_conversation_is_kept_but_window_misses():
+    cache = HistoryCache()
+    cache.append('c', turn(None, 'new'))
+    assert cache.stats()['pending_turns'] == 1
+    # earlier turns may exist in the database, the cache can not answer alone
+    assert cache.get('c', 5) is None
+    cache.put('c', [turn(1)], covers_after=0)
+    assert [t.turn_id for t in cache.get('c', 5)] == ['t1', 'new']
+
+
+def test_stored_turn_of_uncached_conversation_is_ignored():
+    cache = HistoryCache()
+    cache.append('c', turn(1))
+    assert cache.stats()['conversations'] == 0
+
+
+def test_out_of_order_commits_stay_sorted():
+    cache = HistoryCache()
+    cache.put('c', [turn(1)], covers_after=0)
+    cache.append('c', turn(None, 'queued'))
+    cache.append('c', turn(3))
+    cache.append('c', turn(2))
+    assert ordinals(cache.get('c', None)) == [1, 2, 3, None]
+
+
+def test_eviction_skips_conversations_with_queued_turns():
+    cache = HistoryCache(max_conversations=1)
+    cache.append('busy', turn(None, 'queued'))
+    cache.put('idle', [turn(1)], covers_after=0)
+    # everything else goes to get back to the limit, the queued turn stays readable
+    assert list(cache._entries) == ['busy']
+    assert cache.evictions == 1
+
+
+def test_byte_limit_drops_oldest_turns_of_a_single_conversation():
+    cache = HistoryCache(max_bytes=25)
+    cache.put('c', [turn(1), turn(2), turn(3)], covers_after=0)
+    assert ordinals(cache.get('c', 2)) == [2, 3]
+    # turn 1 is gone, a window reaching back to it has to go to the database
+    assert cache.get('c', 3) is None
+    assert cache.nbytes == 20
+
+
+def test_ttl_expires_entries(monkeypatch):
+    import history_cache
+
+    now = [1000.0]
+    monkeypatch.setattr(history_cache.time, 'monotonic', lambda: now[0])
+    cache = HistoryCache(ttl=10)
+    cache.put('c', [turn(1)], covers_after=0)
+    now[0] += 11
+    assert cache.get('c', 5) is None
+    assert cache.nbytes == 0
+
+
+def test_put_returns_loaded_and_queued_turns():
+    cache = HistoryCache()
+    cache.append('c', turn(None, 'queued'))
+    merged = cache.put('c', [turn(1), turn(2)], covers_after=0)
+    assert [t.turn_id for t in select_turns(merged, 20, 0)] == ['t1', 't2', 'queued']
+
+
+def test_newest_stored_and_drop_stored_keeps_queued_turns():
+    cache = HistoryCache()
+    cache.put('c', [turn(1), turn(2)], covers_after=0)
+    cache.append('c', turn(None, 'queued'))
+    assert cache.newest_stored('c') == 2
+    assert cache.newest_stored('other') is None
+
+    cache.drop_stored('c')
+    assert cache.stale == 1
+    # only the queued turn is left and a window read misses until the database is read again
+    assert cache.get('c', last_turns=5) is None
+    merged = cache.put('c', [turn(1), turn(2), turn(3)], covers_after=0)
+    assert [t.turn_id for t in merged] == ['t1', 't2', 't3', 'queued']
+    assert cache.nbytes == 40
+
+
+def test_empty_conversation_is_newest_at_its_cover():
+    cache = HistoryCache()
+    cache.put('c', [], covers_after=0)
+    assert cache.newest_stored('c') == 0
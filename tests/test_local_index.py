@@ -0,0 +1,104 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      The in-process document index, with made up vectors so nothing is embedded
+
+import numpy as np
+import pytest
+
+from document_store import ChunkRecord, content_hash
+from local_index import LocalBackend
+
+DIM = 8
+
+
+def vector(seed):
+    v = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def chunk(source_id, index, content, filename='notes.pdf'):
+    return ChunkRecord(
+        content=content, source_id=source_id, filename=filename, page=1, chunk_index=index,
+        upload_date='2025-01-18', content_hash=content_hash(content),
+    )
+
+
+def add(backend, source_id, contents, filename='notes.pdf', seed=0):
+    pairs = [(chunk(source_id, i, text, filename), vector(seed + i)) for i, text in enumerate(contents)]
+    return backend.add_chunks(pairs)
+
+
+def test_search_finds_the_closest_chunk(tmp_path):
+    backend = LocalBackend(tmp_path)
+    assert add(backend, 'a', ['first chunk', 'second chunk', 'third chunk']) == 3
+    hits = backend.search('', limit=2, query_vector=vector(1))
+    assert [hit.properties['content'] for hit in hits][0] == 'second chunk'
+    assert hits[0].score == pytest.approx(1.0, abs=1e-5)
+    assert len(hits) == 2
+    assert backend.has_source('a')
+
+
+def test_empty_index_finds_nothing(tmp_path):
+    backend = LocalBackend(tmp_path)
+    assert backend.search('', limit=5, query_vector=vector(0)) == []
+    assert backend.keyword_search('anything', limit=5) == []
+
+
+def test_stored_chunks_are_not_added_twice(tmp_path):
+    backend = LocalBackend(tmp_path)
+    add(backend, 'a', ['one', 'two'])
+    assert add(backend, 'a', ['one', 'two']) == 0
+    assert len(backend.search('', limit=10, query_vector=vector(0))) == 2
+
+
+def test_index_survives_reopening(tmp_path):
+    add(LocalBackend(tmp_path), 'a', ['one', 'two'])
+    reopened = LocalBackend(tmp_path)
+    hits = reopened.search('', limit=1, query_vector=vector(0))
+    assert hits[0].properties['content'] == 'one'
+    assert reopened.stored_vectors([content_hash('two')])[content_hash('two')] == pytest.approx(vector(1))
+
+
+def test_dimensions_must_match(tmp_path):
+    backend = LocalBackend(tmp_path)
+    add(backend, 'a', ['one'])
+    with pytest.raises(ValueError):
+        backend.add_chunks([(chunk('b', 0, 'other'), np.ones(DIM + 1, dtype=np.float32))])
+
+
+def test_delete_source(tmp_path):
+    backend = LocalBackend(tmp_path)
+    add(backend, 'old', ['old text'], seed=0)
+    add(backend, 'new', ['new text'], seed=10)
+    # someone else's file with the same name stays
+    add(backend, 'other', ['other file'], seed=20)
+    assert backend.delete_source('old') == 1
+    assert backend.delete_source('old') == 0
+    assert not backend.has_source('old')
+    assert backend.has_source('new') and backend.has_source('other')
+    contents = [hit.properties['content'] for hit in backend.search('', limit=10, query_vector=vector(0))]
+    assert sorted(contents) == ['new text', 'other file']
+    assert [hit.properties['content'] for hit in backend.keyword_search('old text', limit=10)] == ['new text']
+    # deletes are kept in the header
+    assert not LocalBackend(tmp_path).has_source('old')
+
+
+def test_keyword_search(tmp_path):
+    backend = LocalBackend(tmp_path)
+    add(backend, 'a', ['the weather in toronto', 'grade twelve computer science', 'toronto maple leafs'])
+    hits = backend.keyword_search('computer science', limit=5)
+    assert hits[0].properties['content'] == 'grade twelve computer science'
+    assert all('computer' in hit.properties['content'] for hit in hits)
+
+
+def test_ann_index_finds_the_same_rows(tmp_path):
+    backend = LocalBackend(tmp_path, ann_min_rows=50, ann_probe=100)
+    add(backend, 'a', [f'chunk {i}' for i in range(80)])
+    assert backend._ivf is not None
+    hits = backend.search('', limit=1, query_vector=vector(42))
+    assert hits[0].properties['content'] == 'chunk 42'
@@ -0,0 +1,87 @@
+#  Date: 18.01.2025
+#
+#  Author: Amanda Uccello
+#  Class: ICS4UR-1
+#  School: Port Credit Secondary School
+#  Teacher: Mrs. Kim
+#  Description:
+#      The background turn writer against a fake database
+
+import asyncio
+
+from history_cache import CachedTurn, HistoryCache
+from persistence import TurnWriter
+
+
+class FakeDatabase:
+    """Hands out ordinals like the turns table, ``failures`` says how often a turn id fails first."""
+
+    def __init__(self, failures=None):
+        self.history_cache = HistoryCache()
+        self.failures = dict(failures or {})
+        self.calls = []
+        self.next_ordinal = 1
+
+    async def add_turns(self, turns):
+        self.calls.append([t.turn_id for t in turns])
+        for t in turns:
+            if self.failures.get(t.turn_id, 0) > 0:
+                self.failures[t.turn_id] -= 1
+                raise ConnectionError('database went away')
+        ordinals = {}
+        for t in turns:
+            ordinals[t.turn_id] = self.next_ordinal
+            self.next_ordinal += 1
+        return ordinals
+
+
+def write(database, turn_ids, **kwargs):
+    async def main():
+        async with TurnWriter.start(database, flush_interval=0.001, **kwargs) as writer:
+            for turn_id in turn_ids:
+                await writer.submit(turn_id, 'c', b'{}' * 5, [])
+        return writer
+
+    return asyncio.run(main())
+
+
+def cached(database):
+    entry = database.history_cache._entries['c']
+    return [(t.turn_id, t.ordinal) for t in entry.turns]
+
+
+def test_turns_are_written_and_marked_stored():
+    database = FakeDatabase()
+    database.history_cache.put('c', [CachedTurn('old', 0, [], 10)], covers_after=-1)
+    writer = write(database, ['a', 'b'])
+    assert writer.written == 2 and writer.failed == 0
+    assert cached(database) == [('old', 0), ('a', 1), ('b', 2)]
+
+
+def test_failed_write_is_retried():
+    database = FakeDatabase(failures={'a': 1})
+    writer = write(database, ['a'])
+    assert database.calls == [['a'], ['a']]
+    assert writer.written == 1 and writer.failed == 0
+    assert cached(database) == [('a', 1)]
+
+
+def test_dropped_batch_keeps_the_turns_queued_after_it():
+    database = FakeDatabase(failures={'a': 99})
+    writer = write(database, ['a', 'b'], max_batch=1, max_retries=2)
+    assert database.calls == [['a'], ['a'], ['b']]
+    assert writer.failed == 1 and writer.written == 1
+    # only the lost turn is gone, the later one is still cached and got its ordinal
+    assert cached(database) == [('b', 1)]
+    assert database.history_cache.nbytes == 10
+    assert database.history_cache.stats()['pending_turns'] == 0
+
+
+def test_discard_leaves_other_conversations_alone():
+    cache = HistoryCache()
+    cache.append('c', CachedTurn('a', None, [], 10))
+    cache.append('d', CachedTurn('a2', None, [], 10))
+    cache.discard('c', {'a'})
+    cache.discard('missing', {'a'})
+    assert cache._entries['c'].turns == []
+    assert cache.nbytes == 10